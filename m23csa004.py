@@ -20,7 +20,24 @@ print('Done')
 # Importing Libraries
 print('Importing Libraries... ',end='')
 import os
+import io
+import contextlib
+import copy
+import hashlib
+import json
+import math
+import multiprocessing
+import random
+import struct
+import tarfile
+import queue
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import numpy as np
 import pandas as pd
 import torchaudio
 import zipfile
@@ -29,7 +46,7 @@ import IPython.display as ipd
 from matplotlib import pyplot as plt
 from tqdm import tqdm
 import pytorch_lightning as pl
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, IterableDataset, DataLoader, get_worker_info
 import torch
 print('Done')
 
@@ -38,19 +55,29 @@ print('Downlading data... ', end='')
 # Your code here
 print('Done')
 
-# Extract data
-with zipfile.ZipFile("/content/drive/MyDrive/Archive.zip", 'r') as zip_ref:
-    zip_ref.extractall("/content/")
+# Extract data (or read the clips straight from the archive, see ZipAudioArchive below)
+archive_path = "/content/drive/MyDrive/Archive.zip"
+read_from_archive = False  # True skips extraction and reads audio members from the zip
+if not read_from_archive:
+    with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+        zip_ref.extractall("/content/")
 
 # Loading dataset
 path = Path('/content/')
-df = pd.read_csv('/content/meta/esc50.csv')
-
-# Getting list of raw audio files
-wavs = list(path.glob('audio/*'))  # List all audio files in the 'audio' directory using pathlib.Path.glob
-
-# Visualizing data
-waveform, sample_rate = torchaudio.load(wavs[0])  # Load the waveform and sample rate of the first audio file using torchaudio
+if read_from_archive:
+    with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+        df = pd.read_csv(zip_ref.open('meta/esc50.csv'))
+        # Getting list of raw audio members
+        wavs = [name for name in zip_ref.namelist() if name.startswith('audio/') and not name.endswith('/')]
+        # Visualizing data
+        waveform, sample_rate = torchaudio.load(io.BytesIO(zip_ref.read(wavs[0])))
+else:
+    df = pd.read_csv('/content/meta/esc50.csv')
+    # Getting list of raw audio files
+    wavs = list(path.glob('audio/*'))  # List all audio files in the 'audio' directory using pathlib.Path.glob
+
+    # Visualizing data
+    waveform, sample_rate = torchaudio.load(wavs[0])  # Load the waveform and sample rate of the first audio file using torchaudio
 
 print("Shape of waveform: {}".format(waveform.size()))  # Print the shape of the waveform tensor
 print("Sample rate of waveform: {}".format(sample_rate))  # Print the sample rate of the audio file
@@ -62,6 +89,359 @@ plt.plot(waveform.t().numpy())  # Transpose and convert the waveform tensor to a
 # Display the audio using IPython.display.Audio
 ipd.Audio(waveform, rate=sample_rate)  # Create an interactive audio player for the loaded waveform
 
+def window_parameters(new_sampling_rate, sample_length_seconds):
+    # Window and step size (in samples) of the rolling window sample splits
+    if sample_length_seconds == 2:
+        return new_sampling_rate * 2, int(new_sampling_rate * 0.75)
+    return new_sampling_rate, int(new_sampling_rate * 0.5)
+
+class ResamplerBank:
+    """
+    Size-bounded LRU of torchaudio Resample transforms keyed by (source rate, target rate).
+
+    Constructing a Resample transform computes its sinc kernel, so clips that share
+    a source rate reuse one cached transform. Safe to use from several threads.
+    """
+
+    def __init__(self, max_size=8, **resample_kwargs):
+        self.max_size = max_size
+        self.resample_kwargs = resample_kwargs
+        self._resamplers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, orig_freq, new_freq):
+        key = (int(orig_freq), int(new_freq))
+        with self._lock:
+            if key in self._resamplers:
+                self._resamplers.move_to_end(key)
+                return self._resamplers[key]
+        # Build the kernel outside the lock; a concurrent duplicate is simply replaced
+        resampler = Resample(key[0], key[1], **self.resample_kwargs)
+        with self._lock:
+            self._resamplers[key] = resampler
+            while len(self._resamplers) > self.max_size:
+                self._resamplers.popitem(last=False)
+        return resampler
+
+    def __call__(self, waveform, orig_freq, new_freq):
+        if orig_freq == new_freq:
+            return waveform
+        return self.get(orig_freq, new_freq)(waveform)
+
+    def resample_batch(self, waveforms, orig_freqs, new_freq):
+        """
+        Resample clips of mixed rates, one resample call per (source rate, channel count) group.
+
+        Clips in a group are zero-padded to the longest one. The resampler zero-pads the
+        signal edges itself, so trimming each output to its own length gives exactly the
+        single-clip result.
+
+        Returns:
+            The resampled clips, in input order.
+        """
+        groups = {}
+        for position, (waveform, orig_freq) in enumerate(zip(waveforms, orig_freqs)):
+            groups.setdefault((int(orig_freq), waveform.size(0)), []).append(position)
+
+        outputs = [None] * len(waveforms)
+        for (orig_freq, channels), positions in groups.items():
+            lengths = [waveforms[position].size(-1) for position in positions]
+            batch = waveforms[positions[0]].new_zeros(len(positions), channels, max(lengths))
+            for row, position in enumerate(positions):
+                batch[row, :, :lengths[row]] = waveforms[position]
+            resampled = self(batch, orig_freq, new_freq)
+            for row, position in enumerate(positions):
+                outputs[position] = resampled[row, :, :math.ceil(new_freq * lengths[row] / orig_freq)]
+        return outputs
+
+# Shared by the datasets and the inference paths
+resampler_bank = ResamplerBank()
+
+def resampling_margin(resampler):
+    """
+    Context, in whole resampling periods, that a torchaudio Resample kernel reads around a span.
+
+    Returns:
+        The margin in source frames and the matching number of output samples.
+    """
+    period_in = resampler.orig_freq // resampler.gcd
+    period_out = resampler.new_freq // resampler.gcd
+    # Half-width of the windowed sinc kernel in source frames, as computed by torchaudio
+    width = math.ceil(resampler.lowpass_filter_width * period_in / (min(period_in, period_out) * resampler.rolloff))
+    periods = math.ceil(width / period_in)
+    return periods * period_in, periods * period_out
+
+def resample_span(read_frames, num_frames, resampler, start, stop):
+    """
+    Resample source frames [start, stop) exactly as slicing the fully resampled signal would.
+
+    Only the span plus the kernel margin on each side is read. The signal edges are
+    zero-padded just like a full resample, so crops touching them need no special case.
+
+    Args:
+        read_frames: callable (frame_offset, count) -> (channels, count) source frames
+        num_frames: length of the whole source signal
+        resampler: torchaudio Resample transform
+        start, stop: source frame range; start must be a multiple of orig_freq // gcd
+    """
+    period_in = resampler.orig_freq // resampler.gcd
+    period_out = resampler.new_freq // resampler.gcd
+    margin, _ = resampling_margin(resampler)
+    read_start = max(start - margin, 0)
+    read_stop = min(stop + margin, num_frames)
+    audio = resampler(read_frames(read_start, read_stop - read_start))
+    skip = (start - read_start) // period_in * period_out
+    length = -(-(stop - start) * period_out // period_in)
+    return audio[:, skip:skip + length]
+
+class ZipAudioArchive:
+    """
+    Random-access reader for the members of a zip archive, without extracting it.
+
+    The data offset of every member is indexed once from the local file headers.
+    Each process keeps its own open handle, and reading a clip is a single
+    positional read (plus inflating it if the member is deflated).
+    """
+
+    def __init__(self, archive_path):
+        self.archive_path = str(archive_path)
+        self.members = {}
+        with zipfile.ZipFile(self.archive_path) as archive, open(self.archive_path, "rb") as f:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                # The local header (30 bytes + name + extra field) precedes the member data
+                f.seek(info.header_offset)
+                name_length, extra_length = struct.unpack("<HH", f.read(30)[26:30])
+                data_offset = info.header_offset + 30 + name_length + extra_length
+                self.members[info.filename] = (data_offset, info.compress_size, info.compress_type,
+                                               info.CRC, info.file_size)
+        # Open handles keyed by process id, so forked DataLoader workers open their own
+        self._handles = {}
+
+    def __getstate__(self):
+        # File handles do not survive pickling (spawned workers); they are reopened lazily
+        state = self.__dict__.copy()
+        state["_handles"] = {}
+        return state
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def signature(self, name):
+        # CRC and size of the member identify its content without reading it
+        return [self.members[name][3], self.members[name][4]]
+
+    def read(self, name):
+        data_offset, compress_size, compress_type, _, _ = self.members[name]
+        data = os.pread(self._handle().fileno(), compress_size, data_offset)
+        if compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -15)
+        elif compress_type != zipfile.ZIP_STORED:
+            raise ValueError("unsupported compression {} for archive member {}".format(compress_type, name))
+        return data
+
+    def _handle(self):
+        pid = os.getpid()
+        if pid not in self._handles:
+            self._handles[pid] = open(self.archive_path, "rb")
+        return self._handles[pid]
+
+class ResampledAudioCache:
+    """
+    Persistent cache of resampled clips stored as contiguous memory-mapped shards.
+
+    Each clip is decoded and resampled once and appended to a flat shard file
+    (int16 or float32). An offset index (shard, offset, shape, source signature)
+    is kept in index.json, so lookups return views onto the memory map instead of
+    decoding again. Only entries whose source signature changed are rebuilt.
+    """
+
+    def __init__(self, cache_directory, dtype="float32"):
+        self.cache_directory = Path(cache_directory)
+        self.cache_directory.mkdir(parents=True, exist_ok=True)
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.dtype("int16"), np.dtype("float32")):
+            raise ValueError("cache dtype must be int16 or float32, got {}".format(dtype))
+        self.index_path = self.cache_directory / "index.json"
+        self.index = {}
+        if self.index_path.exists():
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        # Memory maps are opened lazily so every DataLoader worker maps its own view
+        self._shards = {}
+
+    def build(self, keys, signatures, load_function):
+        """
+        Resample every key that is missing or stale into a new shard.
+
+        Args:
+            keys: cache keys (the source path as a string)
+            signatures: JSON-serialisable source signature per key
+            load_function: callable returning the resampled (channels, frames) tensor for a key
+
+        Returns:
+            The number of entries that were (re)built.
+        """
+        stale = []
+        for key, signature in zip(keys, signatures):
+            signature = list(signature) + [self.dtype.str]
+            if key not in self.index or self.index[key]["signature"] != signature:
+                stale.append((key, signature))
+        if not stale:
+            return 0
+
+        shard_id = max([entry["shard"] for entry in self.index.values()], default=-1) + 1
+        offset = 0
+        with open(self._shard_path(shard_id), "wb") as shard_file:
+            for key, signature in tqdm(stale):
+                audio = load_function(key).numpy()
+                if self.dtype == np.int16:
+                    audio = np.clip(np.round(audio * 32768.0), -32768, 32767)
+                audio = np.ascontiguousarray(audio, dtype=self.dtype)
+                shard_file.write(audio.tobytes())
+                self.index[key] = {"signature": signature, "shard": shard_id,
+                                   "offset": offset, "shape": list(audio.shape)}
+                offset += audio.size
+
+        self._save_index()
+        return len(stale)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __getitem__(self, key):
+        entry = self.index[key]
+        shard = self._shard(entry["shard"])
+        size = int(np.prod(entry["shape"]))
+        audio = shard[entry["offset"]:entry["offset"] + size].reshape(entry["shape"])
+        if self.dtype == np.int16:
+            # int16 shards halve the disk footprint at the cost of one conversion copy
+            return torch.from_numpy(audio).float() / 32768.0
+        return torch.from_numpy(audio)
+
+    def _shard_path(self, shard_id):
+        return self.cache_directory / "shard_{:05d}.bin".format(shard_id)
+
+    def _shard(self, shard_id):
+        if shard_id not in self._shards:
+            # Copy-on-write mapping: writable for torch.from_numpy, never written back to disk
+            self._shards[shard_id] = np.memmap(self._shard_path(shard_id), dtype=self.dtype, mode="c")
+        return self._shards[shard_id]
+
+    def _save_index(self):
+        temporary_path = self.index_path.with_suffix(".tmp")
+        with open(temporary_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(temporary_path, self.index_path)
+
+        # Drop shards that no longer hold any live entry
+        live_shards = {entry["shard"] for entry in self.index.values()}
+        for shard_path in self.cache_directory.glob("shard_*.bin"):
+            if int(shard_path.stem.split("_")[1]) not in live_shards:
+                shard_path.unlink()
+
+class ManifestIndex:
+    """
+    Columnar index of a manifest CSV built with vectorized column operations.
+
+    Holds the file names, folds, esc10 flags and integer label codes as numpy
+    arrays, so train/val/test queries are boolean masks over arrays instead of
+    per-row DataFrame access. The index can be persisted next to the CSV and
+    built in chunks for manifests that do not fit in memory.
+    """
+
+    def __init__(self, file_names, folds, esc10, label_codes, categories):
+        self.file_names = file_names
+        self.folds = folds
+        self.esc10 = esc10
+        self.label_codes = label_codes
+        # Sorted, so label codes order like the category names; strings are kept as fixed-width arrays
+        self.categories = np.asarray(categories)
+        if self.categories.dtype == object:
+            self.categories = self.categories.astype(str)
+
+    def __len__(self):
+        return len(self.file_names)
+
+    @classmethod
+    def from_data_frame(cls, data_frame, file_column, label_column):
+        label_codes, categories = pd.factorize(data_frame[label_column], sort=True)
+        return cls(data_frame[file_column].to_numpy().astype(str),
+                   data_frame['fold'].to_numpy(dtype=np.int16),
+                   data_frame['esc10'].to_numpy(dtype=bool),
+                   label_codes.astype(np.int32),
+                   categories)
+
+    @classmethod
+    def from_csv(cls, csv_path, file_column, label_column, chunksize=None):
+        # Only the columns the index needs are parsed
+        columns = [file_column, label_column, 'fold', 'esc10']
+        if chunksize is None:
+            return cls.from_data_frame(pd.read_csv(csv_path, usecols=columns), file_column, label_column)
+
+        # Chunked read: factorize labels per chunk against a running category table
+        category_codes = {}
+        file_names, folds, esc10, label_codes = [], [], [], []
+        for chunk in pd.read_csv(csv_path, usecols=columns, chunksize=chunksize):
+            chunk_codes, chunk_categories = pd.factorize(chunk[label_column])
+            for category in chunk_categories:
+                category_codes.setdefault(category, len(category_codes))
+            chunk_to_global = np.array([category_codes[category] for category in chunk_categories], dtype=np.int32)
+            label_codes.append(chunk_to_global[chunk_codes])
+            file_names.append(chunk[file_column].to_numpy().astype(str))
+            folds.append(chunk['fold'].to_numpy(dtype=np.int16))
+            esc10.append(chunk['esc10'].to_numpy(dtype=bool))
+
+        # Renumber the codes so they follow the sorted category names
+        categories = np.array(sorted(category_codes))
+        first_seen_to_sorted = np.empty(len(categories), dtype=np.int32)
+        first_seen_to_sorted[[category_codes[category] for category in categories]] = np.arange(len(categories))
+        return cls(np.concatenate(file_names),
+                   np.concatenate(folds),
+                   np.concatenate(esc10),
+                   first_seen_to_sorted[np.concatenate(label_codes)],
+                   categories)
+
+    @classmethod
+    def load_or_build(cls, csv_path, file_column, label_column, chunksize=None):
+        """
+        Load the index persisted next to the CSV (<csv>.index.npz), rebuilding it
+        when the CSV or the indexed columns changed.
+        """
+        csv_path = Path(csv_path)
+        index_path = csv_path.with_name(csv_path.name + ".index.npz")
+        stat = os.stat(csv_path)
+        signature = json.dumps([stat.st_size, stat.st_mtime_ns, file_column, label_column])
+
+        if index_path.exists():
+            with np.load(index_path) as stored:
+                if stored['signature'].item() == signature:
+                    return cls(stored['file_names'], stored['folds'], stored['esc10'],
+                               stored['label_codes'], stored['categories'])
+
+        manifest_index = cls.from_csv(csv_path, file_column, label_column, chunksize=chunksize)
+        temporary_path = index_path.with_name(index_path.name + ".tmp")
+        with open(temporary_path, "wb") as f:
+            np.savez(f, file_names=manifest_index.file_names, folds=manifest_index.folds,
+                     esc10=manifest_index.esc10, label_codes=manifest_index.label_codes,
+                     categories=manifest_index.categories, signature=np.array(signature))
+        os.replace(temporary_path, index_path)
+        return manifest_index
+
+    def split(self, dataset, validation_fold, testing_fold, esc_10_flag):
+        # Row positions of a "train", "val" or "test" split
+        mask = np.ones(len(self), dtype=bool)
+        if esc_10_flag:
+            mask &= self.esc10
+        if dataset == "train":
+            mask &= (self.folds != validation_fold) & (self.folds != testing_fold)
+        elif dataset == "val":
+            mask &= self.folds == validation_fold
+        elif dataset == "test":
+            mask &= self.folds == testing_fold
+        return np.flatnonzero(mask)
+
 class CustomDataset(Dataset):
     def __init__(self, dataset, **kwargs):
         # Initialize CustomDataset object with relevant parameters
@@ -70,7 +450,7 @@ class CustomDataset(Dataset):
 
         # Extract parameters from kwargs
         self.data_directory = kwargs["data_directory"]
-        self.data_frame = kwargs["data_frame"]
+        self.data_frame = kwargs.get("data_frame")
         self.validation_fold = kwargs["validation_fold"]
         self.testing_fold = kwargs["testing_fold"]
         self.esc_10_flag = kwargs["esc_10_flag"]
@@ -80,24 +460,23 @@ class CustomDataset(Dataset):
         self.new_sampling_rate = kwargs["new_sampling_rate"]
         self.sample_length_seconds = kwargs["sample_length_seconds"]
 
-        # Filter dataframe based on esc_10_flag and data_type
-        if self.esc_10_flag:
-            self.data_frame = self.data_frame.loc[self.data_frame['esc10'] == True]
+        # Optional zip archive to read members from instead of the extracted audio directory
+        self.archive = kwargs.get("archive")
+        if self.archive is None and kwargs.get("archive_path") is not None:
+            self.archive = ZipAudioArchive(kwargs["archive_path"])
 
-        if dataset == "train":
-            self.data_frame = self.data_frame.loc[
-                (self.data_frame['fold'] != self.validation_fold) & (self.data_frame['fold'] != self.testing_fold)]
-        elif dataset == "val":
-            self.data_frame = self.data_frame.loc[self.data_frame['fold'] == self.validation_fold]
-        elif dataset == "test":
-            self.data_frame = self.data_frame.loc[self.data_frame['fold'] == self.testing_fold]
+        # Columnar manifest index (shared across splits when passed in by the data module)
+        self.manifest_index = kwargs.get("manifest_index")
+        if self.manifest_index is None:
+            self.manifest_index = ManifestIndex.from_data_frame(self.data_frame, self.file_column, self.label_column)
 
-        # Get unique categories from the filtered dataframe
-        self.categories = sorted(self.data_frame[self.label_column].unique())
+        # Filter rows based on esc_10_flag and data_type
+        rows = self.manifest_index.split(dataset, self.validation_fold, self.testing_fold, self.esc_10_flag)
+        label_codes = self.manifest_index.label_codes[rows]
 
-        # Initialize lists to hold file names, labels, and folder numbers
-        self.file_names = []
-        self.labels = []
+        # Get unique categories from the filtered rows (codes are ordered like the sorted category names)
+        split_codes = np.unique(label_codes)
+        self.categories = self.manifest_index.categories[split_codes].tolist()
 
         # Initialize dictionaries for category-to-index and index-to-category mapping
         self.category_to_index = {}
@@ -107,76 +486,461 @@ class CustomDataset(Dataset):
             self.category_to_index[category] = i
             self.index_to_category[i] = category
 
-        # Populate file names and labels lists by iterating through the dataframe
-        for ind in tqdm(range(len(self.data_frame))):
-            row = self.data_frame.iloc[ind]
-            file_path = self.data_directory / "audio" / row[self.file_column]
-            self.file_names.append(file_path)
-            self.labels.append(self.category_to_index[row[self.label_column]])
+        # Populate file names and labels from the index columns. Both are flat numpy arrays
+        # (utf-8 byte strings and int64) rather than lists of Python objects, so forked
+        # DataLoader workers never touch refcounts on them and their pages stay shared
+        if self.archive is not None:
+            audio_directory = "audio/"
+        else:
+            audio_directory = str(self.data_directory / "audio") + os.sep
+        self.file_names = np.char.encode(np.char.add(audio_directory, self.manifest_index.file_names[rows]), "utf-8")
+        self.labels = np.searchsorted(split_codes, label_codes).astype(np.int64)
 
-        self.resampler = torchaudio.transforms.Resample(self.sampling_rate, self.new_sampling_rate)
+        # Resampler for the nominal input rate; files at other rates use the shared resampler bank
+        self.resampler = resampler_bank.get(self.sampling_rate, self.new_sampling_rate)
 
         # Window size for rolling window sample splits (unfold method)
-        if self.sample_length_seconds == 2:
-            self.window_size = self.new_sampling_rate * 2
-            self.step_size = int(self.new_sampling_rate * 0.75)
+        self.window_size, self.step_size = window_parameters(self.new_sampling_rate, self.sample_length_seconds)
+
+        # Optional random-crop training: only a random span of each training clip is decoded
+        self.random_crop_length = None
+        if dataset == "train" and kwargs.get("random_crop_seconds") is not None:
+            self.random_crop_length = int(kwargs["random_crop_seconds"] * self.new_sampling_rate)
+            self.check_crop_length(kwargs.get("pooled_head", False))
+
+        # Optional persistent cache: resample every clip once, then serve memory-mapped views
+        self.audio_cache = None
+        self._window_counts = None
+        if kwargs.get("cache_directory") is not None:
+            self.audio_cache = ResampledAudioCache(kwargs["cache_directory"], kwargs.get("cache_dtype", "float32"))
+            paths = [os.fsdecode(path) for path in self.file_names]
+            self.audio_cache.build(paths,
+                                   [self.source_signature(path) for path in paths],
+                                   self.load_resampled)
+
+    def check_crop_length(self, pooled_head):
+        # Cropped training clips are shorter than the evaluation clips: only pooled heads accept them,
+        # and the conv stack still has to produce at least one position from the crop's windows
+        num_windows = (self.random_crop_length - self.window_size) // self.step_size + 1
+        if num_windows < 1:
+            raise ValueError("random crop of {} samples is shorter than one {}-sample window"
+                             .format(self.random_crop_length, self.window_size))
+        if not pooled_head:
+            raise ValueError("random_crop_seconds makes training clips shorter than evaluation clips, which "
+                             "head=\"flatten\" cannot take; use a pooled head and pass pooled_head=True")
+        input_length = num_windows * self.window_size
+        if ConvolutionalBase1(512, ceil_mode=True).output_length(input_length) < 1:
+            raise ValueError("random crop of {} samples ({} model input samples) is below the conv stack's "
+                             "minimum input length".format(self.random_crop_length, input_length))
+
+    def load_resampled(self, path):
+        # Decode a clip and resample it to the model's sampling rate
+        if self.archive is not None:
+            path = io.BytesIO(self.archive.read(path))
+        audio_file = torchaudio.load(path, format=None, normalize=True)
+        return resampler_bank(audio_file[0], audio_file[1], self.new_sampling_rate)
+
+    def source_signature(self, path):
+        # Anything that changes the resampled output invalidates the cached entry
+        # (the source rate is part of the file content, so it is covered by the file signature)
+        if self.archive is not None:
+            source = self.archive.signature(path)
         else:
-            self.window_size = self.new_sampling_rate
-            self.step_size = int(self.new_sampling_rate * 0.5)
+            stat = os.stat(path)
+            source = [stat.st_size, stat.st_mtime_ns]
+        return source + [self.resampler.new_freq, self.resampler.resampling_method,
+                         self.resampler.lowpass_filter_width, self.resampler.rolloff]
+
+    def load_clip(self, index):
+        # Resampled (channels, frames) clip, served from the cache when enabled
+        path = os.fsdecode(self.file_names[index])
+        if self.audio_cache is not None:
+            return self.audio_cache[path]
+        return self.load_resampled(path)
+
+    def resampled_length(self, index):
+        # Length of the resampled clip, from the cache index or the file header (no decoding)
+        if self.random_crop_length is not None:
+            return self.random_crop_length
+        path = os.fsdecode(self.file_names[index])
+        if self.audio_cache is not None:
+            return self.audio_cache.index[path]["shape"][-1]
+        info = torchaudio.info(io.BytesIO(self.archive.read(path)) if self.archive is not None else path)
+        return math.ceil(info.num_frames * self.new_sampling_rate / info.sample_rate)
+
+    def window_counts(self):
+        # Number of windows of every clip, computed once (used for length bucketing)
+        if self._window_counts is None:
+            lengths = np.array([self.resampled_length(index) for index in range(len(self))], dtype=np.int64)
+            self._window_counts = np.maximum((lengths - self.window_size) // self.step_size + 1, 0)
+        return self._window_counts
+
+    def load_random_crop(self, index):
+        # Pick the crop offset first, then decode and resample only that span of the clip
+        if self.audio_cache is not None or self.archive is not None:
+            # Cached clips are sliced for free; archive members have to be read whole anyway
+            clip = self.load_clip(index)
+            offset = torch.randint(0, max(clip.size(1) - self.random_crop_length, 0) + 1, ()).item()
+            return clip[:, offset:offset + self.random_crop_length]
+
+        path = os.fsdecode(self.file_names[index])
+        info = torchaudio.info(path)
+        num_frames = info.num_frames
+        resampler = resampler_bank.get(info.sample_rate, self.new_sampling_rate)
+        period_in = resampler.orig_freq // resampler.gcd
+        period_out = resampler.new_freq // resampler.gcd
+        crop_periods = math.ceil(self.random_crop_length / period_out)
+        start_period = torch.randint(0, max(num_frames // period_in - crop_periods, 0) + 1, ()).item()
+        start = start_period * period_in
+        stop = min(start + crop_periods * period_in, num_frames)
+
+        def read_frames(frame_offset, count):
+            return torchaudio.load(path, frame_offset=frame_offset, num_frames=count, normalize=True)[0]
+
+        return resample_span(read_frames, num_frames, resampler, start, stop)[:, :self.random_crop_length]
 
     def __getitem__(self, index):
         # Split audio files with overlap, pass as stacked tensors tensor with a single label
-        path = self.file_names[index]
-        audio_file = torchaudio.load(path, format=None, normalize=True)
-        audio_tensor = self.resampler(audio_file[0])
+        if self.random_crop_length is not None:
+            audio_tensor = self.load_random_crop(index)
+        else:
+            audio_tensor = self.load_clip(index)
         splits = audio_tensor.unfold(1, self.window_size, self.step_size)
         samples = splits.permute(1, 0, 2)
-        return samples, self.labels[index]
+        return samples, int(self.labels[index])
 
     def __len__(self):
         return len(self.file_names)
 
+def pack_shards(dataset, shard_directory, split, samples_per_shard=1000, dtype="float32"):
+    """
+    Write the resampled clips and labels of a CustomDataset into a few large tar shards.
+
+    Each sample is stored as a "<key>.npy" clip followed by its "<key>.cls" label, and
+    "<split>-shards.json" records the shard files, their sample counts and the categories.
+    Write at least as many shards as DataLoader workers so every worker gets one.
+    """
+    shard_directory = Path(shard_directory)
+    shard_directory.mkdir(parents=True, exist_ok=True)
+
+    def add_member(tar, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+    shards = []
+    for start in tqdm(range(0, len(dataset), samples_per_shard)):
+        shard_name = "{}-{:05d}.tar".format(split, len(shards))
+        stop = min(start + samples_per_shard, len(dataset))
+        with tarfile.open(shard_directory / shard_name, "w") as tar:
+            for index in range(start, stop):
+                clip = io.BytesIO()
+                np.save(clip, dataset.load_clip(index).numpy().astype(dtype))
+                add_member(tar, "{:09d}.npy".format(index), clip.getvalue())
+                add_member(tar, "{:09d}.cls".format(index), str(int(dataset.labels[index])).encode())
+        shards.append({"path": shard_name, "count": stop - start})
+
+    with open(shard_directory / "{}-shards.json".format(split), "w") as f:
+        json.dump({"shards": shards,
+                   "categories": list(dataset.categories),
+                   "sampling_rate": dataset.new_sampling_rate}, f)
+    return shards
+
+class ShardedAudioDataset(IterableDataset):
+    """
+    Streams the samples written by pack_shards with sequential reads only.
+
+    Shards are split across DataLoader workers and, for the training split, shuffled
+    per epoch at shard level and then through a bounded shuffle buffer of samples.
+    Samples are returned exactly like CustomDataset.__getitem__.
+    """
+
+    def __init__(self, dataset, **kwargs):
+        self.shard_directory = Path(kwargs["shard_directory"])
+        self.new_sampling_rate = kwargs["new_sampling_rate"]
+        self.sample_length_seconds = kwargs["sample_length_seconds"]
+        self.shuffle = dataset == "train"
+        self.shuffle_buffer = kwargs.get("shuffle_buffer", 1000)
+        self.seed = kwargs.get("seed", 0)
+        self.epoch = 0
+
+        with open(self.shard_directory / "{}-shards.json".format(dataset)) as f:
+            manifest = json.load(f)
+        if manifest["sampling_rate"] != self.new_sampling_rate:
+            raise ValueError("shards were packed at {} Hz, expected {} Hz".format(
+                manifest["sampling_rate"], self.new_sampling_rate))
+        self.shards = [self.shard_directory / shard["path"] for shard in manifest["shards"]]
+        self.num_samples = sum(shard["count"] for shard in manifest["shards"])
+        self.categories = manifest["categories"]
+
+        # Window size for rolling window sample splits (unfold method)
+        self.window_size, self.step_size = window_parameters(self.new_sampling_rate, self.sample_length_seconds)
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers, epoch_seed = 0, 1, self.epoch
+            self.epoch += 1
+        else:
+            # All workers of one epoch share the DataLoader base seed, so they agree on the shard order
+            worker_id, num_workers, epoch_seed = worker_info.id, worker_info.num_workers, worker_info.seed - worker_info.id
+
+        shards = list(self.shards)
+        if self.shuffle:
+            random.Random(hash((self.seed, epoch_seed))).shuffle(shards)
+        samples = self._read_shards(shards[worker_id::num_workers])
+        if self.shuffle and self.shuffle_buffer > 1:
+            samples = self._shuffle_buffer(samples, random.Random(hash((self.seed, epoch_seed, worker_id))))
+
+        for clip, label in samples:
+            splits = torch.from_numpy(clip).unfold(1, self.window_size, self.step_size)
+            yield splits.permute(1, 0, 2), label
+
+    def __len__(self):
+        return self.num_samples
+
+    def _read_shards(self, shards):
+        for shard in shards:
+            # Streaming mode: members are read strictly in order, no seeking
+            with tarfile.open(shard, "r|") as tar:
+                clip = None
+                for member in tar:
+                    data = tar.extractfile(member).read()
+                    if member.name.endswith(".npy"):
+                        clip = np.load(io.BytesIO(data))
+                    elif member.name.endswith(".cls"):
+                        yield clip, int(data)
+
+    def _shuffle_buffer(self, samples, rng):
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            position = rng.randrange(len(buffer))
+            yield buffer[position]
+            buffer[position] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+class PrefetchDataLoader:
+    """
+    In-process loader that decodes upcoming batches on a bounded thread pool.
+
+    Meant for notebooks and sandboxes where DataLoader workers cannot be forked:
+    while the model trains on the current batch, up to `prefetch_batches` batches
+    are loaded and collated by `num_threads` threads (torchaudio decoding and
+    resampling release the GIL). With num_threads=0 batches are loaded serially.
+    `stall_seconds` holds the time the last pass spent waiting for batches.
+    A batch_sampler, when given, replaces batch_size and shuffle.
+    """
+
+    def __init__(self, dataset, batch_size, shuffle, collate_fn, num_threads=4, prefetch_batches=4, batch_sampler=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.collate_fn = collate_fn
+        self.num_threads = num_threads
+        self.prefetch_batches = max(prefetch_batches, 1)
+        self.batch_sampler = batch_sampler
+        self.stall_seconds = 0.0
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+    def load_batch(self, indices):
+        return self.collate_fn([self.dataset[index] for index in indices])
+
+    def __iter__(self):
+        if self.batch_sampler is not None:
+            batches = iter(self.batch_sampler)
+        else:
+            order = torch.randperm(len(self.dataset)).tolist() if self.shuffle else list(range(len(self.dataset)))
+            batches = iter([order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)])
+        self.stall_seconds = 0.0
+
+        if self.num_threads == 0:
+            for indices in batches:
+                start = time.perf_counter()
+                batch = self.load_batch(indices)
+                self.stall_seconds += time.perf_counter() - start
+                yield batch
+            return
+
+        pool = ThreadPoolExecutor(self.num_threads)
+        try:
+            # Keep a bounded queue of in-flight batches, refilled as each one is consumed
+            pending = deque(pool.submit(self.load_batch, indices) for _, indices in zip(range(self.prefetch_batches), batches))
+            while pending:
+                start = time.perf_counter()
+                batch = pending.popleft().result()
+                self.stall_seconds += time.perf_counter() - start
+                indices = next(batches, None)
+                if indices is not None:
+                    pending.append(pool.submit(self.load_batch, indices))
+                yield batch
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+def compare_loader_stall(dataset, collate_fn, step_function, batch_size=32, num_threads=4, prefetch_batches=4):
+    """
+    Run one pass of step_function over a dataset, loading serially and then with prefetching.
+
+    An untimed warm-up pass reads every file first, so both timed passes see the same
+    (warm) OS page cache. step_function runs several times on the same batches and
+    must not change training state (no optimizer steps on the model being trained).
+
+    Returns:
+        A dict with the loader stall seconds of both passes and the stall time removed.
+    """
+    for batch in PrefetchDataLoader(dataset, batch_size, False, collate_fn, num_threads=num_threads,
+                                    prefetch_batches=prefetch_batches):
+        pass
+    stall = {}
+    for name, threads in (("serial", 0), ("prefetch", num_threads)):
+        loader = PrefetchDataLoader(dataset, batch_size, True, collate_fn, num_threads=threads, prefetch_batches=prefetch_batches)
+        for batch in loader:
+            step_function(batch)
+        stall[name] = loader.stall_seconds
+    stall["removed"] = stall["serial"] - stall["prefetch"]
+    return stall
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler that groups clips of similar length to keep padding small.
+
+    With shuffling, the indices are shuffled, cut into pools of batch_size * pool_batches
+    clips, sorted by length within each pool and split into batches whose order is
+    shuffled again. Without shuffling the whole split is sorted by length. The padded
+    fraction of every pass (padded windows over all windows, which tracks padded
+    tokens) is appended to `epoch_padding_fractions`.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, pool_batches=50):
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_batches = pool_batches
+        self.epoch_padding_fractions = []
+
+    def __len__(self):
+        return math.ceil(len(self.lengths) / self.batch_size)
+
+    def __iter__(self):
+        order = torch.randperm(len(self.lengths)) if self.shuffle else torch.arange(len(self.lengths))
+        pool_size = self.batch_size * self.pool_batches if self.shuffle else max(len(order), 1)
+        batches = []
+        for pool in order.split(pool_size):
+            pool = pool[torch.argsort(self.lengths[pool], stable=True)]
+            batches.extend(pool.split(self.batch_size))
+        if self.shuffle:
+            batches = [batches[position] for position in torch.randperm(len(batches)).tolist()]
+
+        padded = sum(int(self.lengths[batch].max()) * len(batch) for batch in batches)
+        self.epoch_padding_fractions.append(1.0 - float(self.lengths.sum()) / max(padded, 1))
+        for batch in batches:
+            yield batch.tolist()
+
+class PaddingFractionCallback(pl.Callback):
+    # Logs the padded fraction of the epoch's bucketed training batches
+    def on_train_epoch_end(self, trainer, pl_module):
+        data_module = trainer.datamodule
+        batch_sampler = getattr(data_module, "batch_samplers", {}).get(getattr(data_module, "training_dataset", None))
+        if batch_sampler is not None and batch_sampler.epoch_padding_fractions:
+            pl_module.log("train_padding_fraction", batch_sampler.epoch_padding_fractions[-1])
+
 class CustomDataModule(pl.LightningDataModule):
     def __init__(self, **kwargs):
         # Initialize the CustomDataModule with batch size, number of workers, and other parameters
         super().__init__()
         self.batch_size = kwargs["batch_size"]
         self.num_workers = kwargs["num_workers"]
+        # In-process thread-pool prefetching, used only when num_workers == 0
+        self.prefetch_threads = kwargs.get("prefetch_threads", 0)
+        self.prefetch_batches = kwargs.get("prefetch_batches", 4)
+        # Flat batches of independent windows plus their clip index (see window_collate_function)
+        self.window_batching = kwargs.get("window_batching", False)
+        # Length-bucketed batches of variable-length clips with a padding mask
+        self.bucket_batching = kwargs.get("bucket_batching", False)
+        self.bucket_pool_batches = kwargs.get("bucket_pool_batches", 50)
+        self.batch_samplers = {}
+        # TrainingThroughputMonitor timing collate_function (set by ThroughputCallback or the training loop)
+        self.throughput_monitor = None
         self.data_module_kwargs = kwargs
 
     def setup(self, stage=None):
         # Define datasets for training, validation, and testing during Lightning setup
 
+        if not self.data_module_kwargs.get("use_shards"):
+            # Index the archive once and share it across the three splits
+            if self.data_module_kwargs.get("archive_path") is not None and self.data_module_kwargs.get("archive") is None:
+                self.data_module_kwargs["archive"] = ZipAudioArchive(self.data_module_kwargs["archive_path"])
+
+            # Index the manifest once and share it across the three splits
+            if self.data_module_kwargs.get("manifest_index") is None:
+                self.data_module_kwargs["manifest_index"] = ManifestIndex.from_data_frame(
+                    self.data_module_kwargs["data_frame"],
+                    self.data_module_kwargs["file_column"],
+                    self.data_module_kwargs["label_column"])
+
         # If in 'fit' or None stage, create training and validation datasets
         if stage == 'fit' or stage is None:
-            self.training_dataset = CustomDataset(dataset="train", **self.data_module_kwargs)
-            self.validation_dataset = CustomDataset(dataset="val", **self.data_module_kwargs)
+            self.training_dataset = self.make_dataset("train")
+            self.validation_dataset = self.make_dataset("val")
 
         # If in 'test' or None stage, create testing dataset
         if stage == 'test' or stage is None:
-            self.testing_dataset = CustomDataset(dataset="test", **self.data_module_kwargs)
+            self.testing_dataset = self.make_dataset("test")
+
+    def make_dataset(self, dataset):
+        # Stream packed shards when use_shards is set, otherwise read the individual files
+        if self.data_module_kwargs.get("use_shards"):
+            return ShardedAudioDataset(dataset=dataset, **self.data_module_kwargs)
+        return CustomDataset(dataset=dataset, **self.data_module_kwargs)
+
+    def pack_shards(self, shard_directory, samples_per_shard=1000):
+        # Pack the three splits into sequential-read shards, to be used with use_shards=True
+        for dataset in ("train", "val", "test"):
+            pack_shards(CustomDataset(dataset=dataset, **self.data_module_kwargs),
+                        shard_directory, dataset, samples_per_shard)
 
     def train_dataloader(self):
         # Return DataLoader for training dataset
-        return DataLoader(self.training_dataset,
-                          batch_size=self.batch_size,
-                          shuffle=True,
-                          collate_fn=self.collate_function,
-                          num_workers=self.num_workers)
+        return self.make_dataloader(self.training_dataset, batch_size=self.batch_size, shuffle=True)
 
     def val_dataloader(self):
         # Return DataLoader for validation dataset
-        return DataLoader(self.validation_dataset,
-                          batch_size=self.batch_size,
-                          shuffle=False,
-                          collate_fn=self.collate_function,
-                          num_workers=self.num_workers)
+        return self.make_dataloader(self.validation_dataset, batch_size=self.batch_size, shuffle=False)
 
     def test_dataloader(self):
         # Return DataLoader for testing dataset
-        return DataLoader(self.testing_dataset,
-                          batch_size=32,
-                          shuffle=False,
+        return self.make_dataloader(self.testing_dataset, batch_size=32, shuffle=False)
+
+    def make_dataloader(self, dataset, batch_size, shuffle):
+        batch_sampler = None
+        if isinstance(dataset, IterableDataset):
+            # Iterable shard datasets shuffle themselves
+            shuffle = False
+        elif self.bucket_batching:
+            # Group clips of similar length; padded_collate_function pads and masks the rest
+            batch_sampler = BucketBatchSampler(dataset.window_counts(), batch_size, shuffle, self.bucket_pool_batches)
+            self.batch_samplers[dataset] = batch_sampler
+
+        # Without worker processes, decode the next batches on a thread pool instead
+        if self.num_workers == 0 and self.prefetch_threads > 0 and not isinstance(dataset, IterableDataset):
+            return PrefetchDataLoader(dataset, batch_size, shuffle, self.collate_function,
+                                      num_threads=self.prefetch_threads, prefetch_batches=self.prefetch_batches,
+                                      batch_sampler=batch_sampler)
+        if batch_sampler is not None:
+            return DataLoader(dataset,
+                              batch_sampler=batch_sampler,
+                              collate_fn=self.collate_function,
+                              num_workers=self.num_workers)
+        return DataLoader(dataset,
+                          batch_size=batch_size,
+                          shuffle=shuffle,
                           collate_fn=self.collate_function,
                           num_workers=self.num_workers)
 
@@ -192,22 +956,122 @@ class CustomDataModule(pl.LightningDataModule):
         Returns:
             A list containing examples (concatenated tensors) and labels (flattened tensor).
         """
+        with self.throughput_monitor.collate_timer() if self.throughput_monitor is not None else contextlib.nullcontext():
+            if self.window_batching:
+                return self.window_collate_function(data)
+            if self.bucket_batching:
+                return self.padded_collate_function(data)
+
+            examples, labels = zip(*data)
+            examples = torch.stack(examples)
+            examples =examples.reshape(examples.size(0),1,-1)
+            labels = torch.flatten(torch.tensor(labels))
+
+            return [examples, labels]
+
+    def window_collate_function(self, data):
+        """
+        Collate function that treats every window as an independent sample.
+
+        Args:
+            data: a tuple of 2 tuples with (example, label) where
+                example are the split sub-frame audio tensors per file (any number per file)
+                label = the label
+
+        Returns:
+            A list containing the windows of all clips (num_windows, 1, window_size), the clip
+            labels (flattened tensor) and the clip index of every window.
+        """
         examples, labels = zip(*data)
-        examples = torch.stack(examples)
-        examples =examples.reshape(examples.size(0),1,-1)
+        counts = torch.tensor([example.size(0) for example in examples])
+        windows = torch.cat(examples)
+        clip_index = torch.repeat_interleave(torch.arange(len(examples)), counts)
         labels = torch.flatten(torch.tensor(labels))
 
-        return [examples, labels]
+        return [windows, labels, clip_index]
+
+    def padded_collate_function(self, data):
+        """
+        Collate function for clips with different numbers of windows.
+
+        Args:
+            data: a tuple of 2 tuples with (example, label) where
+                example are the split sub-frame audio tensors per file (any number per file)
+                label = the label
+
+        Returns:
+            A list containing examples zero-padded to the longest clip (concatenated tensors),
+            labels (flattened tensor) and a (batch_size, max_windows) padding mask that is
+            True for padded windows.
+        """
+        examples, labels = zip(*data)
+        counts = torch.tensor([example.size(0) for example in examples])
+        examples = torch.nn.utils.rnn.pad_sequence(examples, batch_first=True)
+        padding_mask = torch.arange(examples.size(1)) >= counts.unsqueeze(1)
+        examples = examples.reshape(examples.size(0), 1, -1)
+        labels = torch.flatten(torch.tensor(labels))
+
+        return [examples, labels, padding_mask]
+
+def unique_set_size():
+    # Private (unshared) memory of the calling process in bytes, Private_Clean + Private_Dirty (Linux /proc).
+    # RSS is useless here: a copy-on-write fault in a forked worker swaps a shared page for a
+    # private one and leaves RSS unchanged, while USS grows by that page.
+    size = 0
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            if line.startswith(("Private_Clean:", "Private_Dirty:")):
+                size += int(line.split()[1]) * 1024
+    return size
+
+def _worker_uss_collate(data):
+    # Runs inside the worker after the batch was loaded: report (worker id, USS) instead of tensors
+    return torch.utils.data.get_worker_info().id, unique_set_size()
+
+def measure_worker_memory_growth(dataset, num_workers=2, batch_size=32):
+    """
+    Iterate over a dataset with forked DataLoader workers and report per-worker private memory growth.
+
+    Returns:
+        A dict mapping worker id to (first batch USS, last batch USS, growth) in MiB.
+    """
+    # An IterableDataset (ShardedAudioDataset) shuffles itself and DataLoader rejects shuffle=True for it
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=not isinstance(dataset, IterableDataset),
+                        num_workers=num_workers, collate_fn=_worker_uss_collate)
+    first, last = {}, {}
+    for worker_id, uss in loader:
+        first.setdefault(worker_id, uss)
+        last[worker_id] = uss
+    mib = 1024 ** 2
+    return {worker_id: (first[worker_id] / mib, last[worker_id] / mib, (last[worker_id] - first[worker_id]) / mib)
+            for worker_id in sorted(first)}
+
+def check_worker_memory_growth(dataset, num_workers=2, batch_size=32, max_growth_mib=64.0):
+    # Fails when any worker's private memory grows by more than max_growth_mib over one epoch
+    # (copy-on-write of the dataset's per-sample Python objects shows up here)
+    growth = measure_worker_memory_growth(dataset, num_workers, batch_size)
+    for worker_id, (first_mib, last_mib, growth_mib) in growth.items():
+        if growth_mib > max_growth_mib:
+            raise AssertionError("worker {} private memory grew {:.1f} MiB ({:.1f} -> {:.1f}) over one epoch, "
+                                 "limit {:.1f} MiB".format(worker_id, growth_mib, first_mib, last_mib, max_growth_mib))
+    return growth
 
 # Data Setup
 test_samp = 1 #Do not change this!! """
 valid_samp = 2 # Use any value ranging from 2 to 5 for k-fold validation (valid_fold)
 batch_size = 32 # Free to change
 num_workers = 0 # Free to change
+# Columnar index of the manifest, persisted next to the CSV (pass chunksize=... for very large manifests)
+if read_from_archive:
+    manifest_index = ManifestIndex.from_data_frame(df, 'filename', 'category')
+else:
+    manifest_index = ManifestIndex.load_or_build('/content/meta/esc50.csv', 'filename', 'category')
 custom_data_module = CustomDataModule(batch_size=batch_size,
                                       num_workers=num_workers,
                                       data_directory=path,
                                       data_frame=df,
+                                      manifest_index=manifest_index,
+                                      archive_path=archive_path if read_from_archive else None,
                                       validation_fold=valid_samp,
                                       testing_fold=test_samp,  # set to 0 for no test set
                                       esc_10_flag=True,
@@ -215,14 +1079,29 @@ custom_data_module = CustomDataModule(batch_size=batch_size,
                                       label_column='category',
                                       sampling_rate=44100,
                                       new_sampling_rate=16000,  # new sample rate for input
-                                      sample_length_seconds=1  # new length of input in seconds
+                                      sample_length_seconds=1,  # new length of input in seconds
+                                      random_crop_seconds=None,  # e.g. 2 to decode only a random 2 s crop of each training clip
+                                      pooled_head=False,  # True when the model uses a pooled head (needed for random_crop_seconds)
+                                      cache_directory=None,  # e.g. '/content/cache' to resample each clip only once
+                                      cache_dtype='float32',  # 'int16' halves the cache size
+                                      use_shards=False,  # stream packed shards (see CustomDataModule.pack_shards)
+                                      shard_directory='/content/shards',
+                                      shuffle_buffer=1000,
+                                      prefetch_threads=4,  # decode ahead on threads while num_workers = 0
+                                      prefetch_batches=4,  # queue depth of prefetched batches
+                                      window_batching=False,  # flat batches of 1 s windows, for WindowLevelClassifier
+                                      bucket_batching=False  # length-bucketed batches with a padding mask, for variable-length clips
                                       )
 
+#custom_data_module.pack_shards('/content/shards')  # run once before setting use_shards=True
 custom_data_module.setup()
 
 # Data Exploration
-print('Class Label: ', custom_data_module.training_dataset[0][1])  # this prints the class label
-print('Shape of data sample tensor: ', custom_data_module.training_dataset[0][0].shape)  # this prints the shape of the sample (Frames, Channel, Features)
+first_sample = next(iter(custom_data_module.training_dataset))  # works for file and sharded datasets
+print('Class Label: ', first_sample[1])  # this prints the class label
+print('Shape of data sample tensor: ', first_sample[0].shape)  # this prints the shape of the sample (Frames, Channel, Features)
+# Forked workers must not copy the dataset's pages over an epoch (one extra decoding epoch; raises past max_growth_mib)
+#print('Worker USS (first, last, growth) MiB: ', check_worker_memory_growth(custom_data_module.training_dataset, num_workers=2))
 
 # Dataloader(s)
 x = next(iter(custom_data_module.train_dataloader()))
@@ -252,9 +1131,45 @@ from torchsummary import summary
 
 # Assuming custom_data_module contains your custom dataset and dataloaders
 
+# Length-agnostic pooling used by the pooled classifier heads
+class SequencePool(nn.Module):
+    """
+    Pools a (batch_size, seq_length, channels) sequence into (batch_size, channels).
+
+    mode: "mean", "max", "attention" (learned softmax weights over positions)
+    or "cls" (the first token, for the transformer classifier).
+    """
+
+    def __init__(self, channels, mode="mean"):
+        super(SequencePool, self).__init__()
+        if mode not in ("mean", "max", "attention", "cls"):
+            raise ValueError("unknown pooling mode {!r}".format(mode))
+        self.mode = mode
+        if mode == "attention":
+            self.score = nn.Linear(channels, 1)
+
+    def forward(self, x, padding_mask=None):
+        # padding_mask: (batch_size, seq_length), True for padded positions to leave out
+        if self.mode == "cls":
+            return x[:, 0]
+        if self.mode == "max":
+            if padding_mask is not None:
+                x = x.masked_fill(padding_mask.unsqueeze(-1), float("-inf"))
+            return x.amax(dim=1)
+        if self.mode == "attention":
+            scores = self.score(x).squeeze(-1)
+            if padding_mask is not None:
+                scores = scores.masked_fill(padding_mask, float("-inf"))
+            weights = F.softmax(scores, dim=1)
+            return torch.bmm(weights.unsqueeze(1), x).squeeze(1)
+        if padding_mask is not None:
+            valid = (~padding_mask).unsqueeze(-1).to(x.dtype)
+            return (x * valid).sum(dim=1) / valid.sum(dim=1).clamp(min=1)
+        return x.mean(dim=1)
+
 # Define your Conv1DClassifier model
 class Conv1DClassifier(nn.Module):
-    def __init__(self, num_classes):
+    def __init__(self, num_classes, head="flatten"):
         super(Conv1DClassifier, self).__init__()
         self.conv1 = nn.Conv1d(in_channels=1, out_channels=32, kernel_size=11, stride=5, padding=5)
         self.conv2 = nn.Conv1d(in_channels=32, out_channels=64, kernel_size=9, stride=5, padding=4)
@@ -262,12 +1177,24 @@ class Conv1DClassifier(nn.Module):
         self.conv4 = nn.Conv1d(in_channels=128, out_channels=256, kernel_size=5, stride=2, padding=2)
         self.conv5 = nn.Conv1d(in_channels=256, out_channels=512, kernel_size=3, stride=1, padding=1)
 
-        self.pool = nn.MaxPool1d(kernel_size=3, stride=3)
-        #val = 512*(144000/243)      #this will be used if stride =1,here 243= (3^5)
-        self.fc1 = nn.Linear(2048, 128)
+        # head="flatten" ties fc1 to 144000-sample inputs; "mean", "max" and "attention" pool over
+        # time and accept any length (ceil_mode keeps a partial last pooling window for short clips)
+        self.head = head
+        if head == "flatten":
+            self.pool = nn.MaxPool1d(kernel_size=3, stride=3)
+            #val = 512*(144000/243)      #this will be used if stride =1,here 243= (3^5)
+            self.fc1 = nn.Linear(2048, 128)
+        else:
+            self.pool = nn.MaxPool1d(kernel_size=3, stride=3, ceil_mode=True)
+            self.sequence_pool = SequencePool(512, head)
+            self.fc1 = nn.Linear(512, 128)
         self.fc2 = nn.Linear(128, num_classes)
 
     def forward(self, x):
+        return self.classify_features(self.features(x))
+
+    def features(self, x):
+        # Conv stack: (batch_size, 1, length) -> (batch_size, 512, positions)
         x = F.relu(self.conv1(x))
         x = self.pool(x)
         x = F.relu(self.conv2(x))
@@ -278,11 +1205,641 @@ class Conv1DClassifier(nn.Module):
         x = self.pool(x)
         x = F.relu(self.conv5(x))
         x = self.pool(x)
-        x = torch.flatten(x, 1)
+        return x
+
+    def classify_features(self, x):
+        # Head on the conv features, shared with StreamingClassifier
+        if self.head == "flatten":
+            x = torch.flatten(x, 1)
+        else:
+            x = self.sequence_pool(x.transpose(1, 2))
         x = F.relu(self.fc1(x))
         x = self.fc2(x)
         return x
 
+# Window-level variant: the same conv stack classifies each window on its own (global max over time)
+class Conv1DWindowClassifier(Conv1DClassifier):
+    def __init__(self, num_classes):
+        super(Conv1DWindowClassifier, self).__init__(num_classes, head="max")
+
+def aggregate_window_logits(logits, clip_index, num_clips, reduction="mean"):
+    # Scatter-mean or scatter-max of per-window logits back to their clips
+    index = clip_index.unsqueeze(1).expand_as(logits)
+    if reduction == "max":
+        clip_logits = logits.new_full((num_clips, logits.size(1)), float("-inf"))
+        return clip_logits.scatter_reduce(0, index, logits, reduce="amax", include_self=True)
+    clip_logits = logits.new_zeros((num_clips, logits.size(1)))
+    return clip_logits.scatter_reduce(0, index, logits, reduce="mean", include_self=False)
+
+class WindowLevelClassifier(nn.Module):
+    """
+    Runs a per-window model once over a flat batch of windows (window_batching=True)
+    and aggregates its logits to one prediction per clip.
+    """
+
+    def __init__(self, window_model, reduction="mean"):
+        super(WindowLevelClassifier, self).__init__()
+        self.window_model = window_model
+        self.reduction = reduction
+
+    def forward(self, windows, clip_index, num_clips=None):
+        if num_clips is None:
+            num_clips = int(clip_index.max()) + 1
+        logits = self.window_model(windows)
+        return aggregate_window_logits(logits, clip_index, num_clips, self.reduction)
+
+def is_window_batch(batch):
+    # window_collate_function batches are (windows, labels, clip_index); a padded batch ends in a bool mask
+    return len(batch) == 3 and batch[2].dtype != torch.bool
+
+def forward_batch(model, batch):
+    """
+    Clip logits of a collated batch (tensors already on the model's device), for training and evaluation.
+
+    Window batches need a WindowLevelClassifier, which reduces the per-window logits by
+    clip_index (num_clips is passed, so clips without windows keep their row); a
+    ConvolutionalTransformerClassifier handles them itself. Padded batches pass their mask on.
+    """
+    if isinstance(model, ConvolutionalTransformerClassifier):
+        return model.batch_logits(batch)
+    if is_window_batch(batch):
+        if not isinstance(model, WindowLevelClassifier):
+            raise ValueError("window_batching=True batches need a WindowLevelClassifier, "
+                             "e.g. WindowLevelClassifier(Conv1DWindowClassifier(num_classes)), got {}"
+                             .format(type(model).__name__))
+        return model(batch[0], batch[2], num_clips=batch[1].size(0))
+    return model(batch[0], *batch[2:])
+
+class ConfusionMatrixAccumulator:
+    """
+    Streaming (true class, predicted class) counts, updated per batch with one bincount on the batch's device.
+
+    Accumulators of different processes or shards combine with merge() or all_reduce().
+    """
+
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+        self.counts = None
+
+    def update(self, logits, labels):
+        # logits (batch_size, num_classes) or predicted class indices (batch_size,)
+        predictions = logits.argmax(dim=1) if logits.dim() == 2 else logits
+        counts = torch.bincount(labels.long() * self.num_classes + predictions.long(),
+                                minlength=self.num_classes ** 2).view(self.num_classes, self.num_classes)
+        self.counts = counts if self.counts is None else self.counts + counts
+        return self
+
+    def merge(self, other):
+        if other.counts is not None:
+            self.counts = other.counts.clone() if self.counts is None else self.counts + other.counts.to(self.counts.device)
+        return self
+
+    def all_reduce(self):
+        # Sum over the processes of an initialised torch.distributed group
+        if self.counts is None:
+            self.counts = torch.zeros(self.num_classes, self.num_classes, dtype=torch.long)
+        torch.distributed.all_reduce(self.counts)
+        return self
+
+    def compute(self):
+        if self.counts is None:
+            return torch.zeros(self.num_classes, self.num_classes, dtype=torch.long)
+        return self.counts.cpu()
+
+    def accuracy(self):
+        counts = self.compute()
+        return counts.diag().sum().item() / max(counts.sum().item(), 1)
+
+class BinnedROCAccumulator:
+    """
+    Per-class one-vs-rest ROC curves and AUC from histograms of the predicted probabilities.
+
+    Each class keeps two num_bins histograms of its probability (over positive and over
+    negative samples), so memory is O(num_classes * num_bins), whatever the number of samples.
+    The curve points are the exact ROC points at the bin edges as thresholds. Samples that
+    share a bin count as tied, so the AUC differs from the exact (sklearn) AUC only through
+    positive/negative pairs in the same bin:
+
+        |AUC_binned - AUC_exact| <= 0.5 * sum_b positives_b * negatives_b / (P * N)
+
+    auc_error_bound() evaluates this bound from the histograms; it shrinks with num_bins
+    unless the scores pile up in a few bins (saturated probabilities).
+    """
+
+    def __init__(self, num_classes, num_bins=1000):
+        self.num_classes = num_classes
+        self.num_bins = num_bins
+        self.positives = None
+        self.negatives = None
+
+    def update(self, probabilities, labels):
+        probabilities = probabilities.detach().float()
+        bins = (probabilities * self.num_bins).long().clamp_(0, self.num_bins - 1)
+        index = (torch.arange(self.num_classes, device=bins.device) * self.num_bins + bins).flatten()
+        positive = F.one_hot(labels.long(), self.num_classes).bool().flatten()
+        size = self.num_classes * self.num_bins
+        positives = torch.bincount(index[positive], minlength=size).view(self.num_classes, self.num_bins)
+        negatives = torch.bincount(index[~positive], minlength=size).view(self.num_classes, self.num_bins)
+        if self.positives is None:
+            self.positives, self.negatives = positives, negatives
+        else:
+            self.positives += positives
+            self.negatives += negatives
+        return self
+
+    def merge(self, other):
+        if other.positives is not None:
+            if self.positives is None:
+                self.positives, self.negatives = other.positives.clone(), other.negatives.clone()
+            else:
+                self.positives += other.positives.to(self.positives.device)
+                self.negatives += other.negatives.to(self.negatives.device)
+        return self
+
+    def all_reduce(self):
+        # Sum over the processes of an initialised torch.distributed group
+        if self.positives is None:
+            self.positives = torch.zeros(self.num_classes, self.num_bins, dtype=torch.long)
+            self.negatives = torch.zeros(self.num_classes, self.num_bins, dtype=torch.long)
+        torch.distributed.all_reduce(self.positives)
+        torch.distributed.all_reduce(self.negatives)
+        return self
+
+    def roc_curves(self):
+        # (fpr, tpr) of shape (num_classes, num_bins + 1), thresholds from the top bin edge down
+        positives = self.positives.cpu().double().flip(1).cumsum(1)
+        negatives = self.negatives.cpu().double().flip(1).cumsum(1)
+        tpr = F.pad(positives / positives[:, -1:].clamp(min=1), (1, 0))
+        fpr = F.pad(negatives / negatives[:, -1:].clamp(min=1), (1, 0))
+        return fpr, tpr
+
+    def roc_auc(self):
+        fpr, tpr = self.roc_curves()
+        return torch.trapezoid(tpr, fpr, dim=1)
+
+    def auc_error_bound(self):
+        positives, negatives = self.positives.cpu().double(), self.negatives.cpu().double()
+        pairs = positives.sum(1) * negatives.sum(1)
+        return 0.5 * (positives * negatives).sum(1) / pairs.clamp(min=1)
+
+class StreamingEvaluation:
+    # Bounded-memory alternative to SplitEvaluation for evaluate_split: no logits are stored
+    def __init__(self, num_classes, num_bins=1000):
+        self.num_classes = num_classes
+        self.confusion = ConfusionMatrixAccumulator(num_classes)
+        self.roc = BinnedROCAccumulator(num_classes, num_bins)
+
+    def update(self, logits, labels):
+        logits = logits.detach()
+        self.confusion.update(logits, labels)
+        self.roc.update(torch.softmax(logits.float(), dim=1), labels)
+
+    def merge(self, other):
+        self.confusion.merge(other.confusion)
+        self.roc.merge(other.roc)
+        return self
+
+    def all_reduce(self):
+        self.confusion.all_reduce()
+        self.roc.all_reduce()
+        return self
+
+    def accuracy(self):
+        return torch.tensor(self.confusion.accuracy())
+
+    def confusion_matrix(self):
+        return self.confusion.compute()
+
+class SplitEvaluation:
+    """
+    Logits and labels of one pass over a split, stored in preallocated tensors.
+
+    Accuracy, the confusion matrix and the class probabilities (for the classification
+    report and ROC curves) are all derived from the stored logits, so every split is
+    decoded and forwarded once. The buffers live on the logits' device and double in
+    size when a split holds more samples than `capacity`.
+    """
+
+    def __init__(self, num_classes, capacity=None):
+        self.num_classes = num_classes
+        self.capacity = capacity or 1024
+        self.logits = None
+        self.labels = None
+        self.count = 0
+
+    def update(self, logits, labels):
+        logits = logits.detach()
+        if self.logits is None:
+            self.logits = logits.new_empty((self.capacity, self.num_classes), dtype=torch.float32)
+            self.labels = labels.new_empty(self.capacity, dtype=torch.long)
+        end = self.count + logits.size(0)
+        if end > self.logits.size(0):
+            grow = max(end, 2 * self.logits.size(0)) - self.logits.size(0)
+            self.logits = torch.cat([self.logits, self.logits.new_empty((grow, self.num_classes))])
+            self.labels = torch.cat([self.labels, self.labels.new_empty(grow)])
+        self.logits[self.count:end] = logits
+        self.labels[self.count:end] = labels
+        self.count = end
+
+    def stored_logits(self):
+        return self.logits[:self.count]
+
+    def stored_labels(self):
+        return self.labels[:self.count]
+
+    def predictions(self):
+        return self.stored_logits().argmax(dim=1)
+
+    def probabilities(self):
+        return torch.softmax(self.stored_logits(), dim=1)
+
+    def accuracy(self):
+        # Fraction of correct predictions as a 0-dim tensor (no host sync until it is read)
+        if self.count == 0:
+            return torch.tensor(float("nan"))
+        return (self.predictions() == self.stored_labels()).float().mean()
+
+    def confusion_matrix(self):
+        # (true class, predicted class) counts
+        return ConfusionMatrixAccumulator(self.num_classes).update(self.predictions(), self.stored_labels()).compute()
+
+def dataloader_num_samples(dataloader):
+    # Number of samples behind a dataloader, or None when the dataset has no length (shards)
+    try:
+        return len(dataloader.dataset)
+    except (AttributeError, TypeError):
+        return None
+
+def evaluate_split(model, dataloader, num_classes, device, evaluation=None):
+    # One inference-mode pass over a split into a SplitEvaluation (or the given StreamingEvaluation)
+    model.eval()
+    if evaluation is None:
+        evaluation = SplitEvaluation(num_classes, dataloader_num_samples(dataloader))
+    with torch.inference_mode():
+        for batch in dataloader:
+            inputs = [tensor.to(device) for tensor in batch]
+            evaluation.update(forward_batch(model, inputs), inputs[1])
+    return evaluation
+
+class RunningMetrics:
+    """
+    Loss and accuracy sums that stay on the device during an epoch.
+
+    update() only queues in-place tensor additions, so a training step never waits for
+    the GPU; compute() reads the sums back once, at the end of the epoch.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = torch.zeros((), device=self.device)
+        self.correct = torch.zeros((), dtype=torch.long, device=self.device)
+        self.total = 0
+        self.num_batches = 0
+
+    def update(self, loss, logits, labels):
+        self.loss_sum += loss.detach()
+        self.correct += (logits.detach().argmax(dim=1) == labels).sum()
+        self.total += labels.size(0)  # a host-side shape, no sync
+        self.num_batches += 1
+
+    def compute(self):
+        return {"loss": self.loss_sum.item() / max(self.num_batches, 1),
+                "accuracy": 100 * self.correct.item() / max(self.total, 1)}
+
+class LocalMetricSink:
+    """
+    Offline metric log: records are appended as JSON lines by a background thread.
+
+    log() only puts the record on a queue. The writer thread takes everything queued,
+    converts tensors to numbers (any device sync happens there, not in the training
+    loop) and appends the batch with one write, at most every flush_seconds.
+    Pass tensors that are not modified in place afterwards (e.g. loss.detach()).
+    Values json cannot encode (numpy scalars/arrays, tensors nested in lists) go through
+    _json_value; a record that still fails is counted in dropped and reported, not fatal.
+    """
+
+    def __init__(self, path, flush_seconds=1.0):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.flush_seconds = flush_seconds
+        self.records = queue.Queue()
+        self.closed = threading.Event()
+        self.dropped = 0
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def log(self, record):
+        self.records.put(dict(record, time=time.time()))
+
+    @staticmethod
+    def _json_value(value):
+        # json.dumps default= hook for tensors and numpy values
+        if torch.is_tensor(value):
+            value = value.detach().cpu()
+            return value.item() if value.numel() == 1 else value.tolist()
+        if isinstance(value, (np.generic, np.ndarray)):
+            return value.tolist()
+        return str(value)
+
+    def _write_loop(self):
+        with open(self.path, "a") as f:
+            while not (self.closed.is_set() and self.records.empty()):
+                self.closed.wait(self.flush_seconds)
+                taken, lines = 0, []
+                try:
+                    while not self.records.empty():
+                        record = self.records.get()
+                        taken += 1
+                        try:
+                            lines.append(json.dumps(record, default=self._json_value))
+                        except (TypeError, ValueError) as error:
+                            self.dropped += 1
+                            print("LocalMetricSink: dropped record {!r}: {!r}".format(record, error))
+                    if lines:
+                        f.write("\n".join(lines) + "\n")
+                        f.flush()
+                finally:
+                    # Every record taken is accounted for, so flush() cannot wait on it forever
+                    for _ in range(taken):
+                        self.records.task_done()
+
+    def flush(self):
+        # Block until everything logged so far is on disk; raises if the writer thread died
+        with self.records.all_tasks_done:
+            while self.records.unfinished_tasks:
+                if not self.writer.is_alive():
+                    raise RuntimeError("LocalMetricSink writer thread is not running, {} records unwritten"
+                                       .format(self.records.unfinished_tasks))
+                self.records.all_tasks_done.wait(0.1)
+
+    def close(self):
+        # Write what is still queued and stop the writer thread
+        self.closed.set()
+        self.writer.join()
+
+def read_metric_log(path):
+    # LocalMetricSink records as a DataFrame
+    return pd.read_json(path, lines=True)
+
+class LocalMetricLogger(pl.loggers.Logger):
+    """Lightning logger writing through a LocalMetricSink, e.g. pl.Trainer(logger=LocalMetricLogger(...))."""
+
+    def __init__(self, path, name="local", version="0", flush_seconds=1.0):
+        super(LocalMetricLogger, self).__init__()
+        self.sink = LocalMetricSink(path, flush_seconds)
+        self._name = name
+        self._version = version
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def version(self):
+        return self._version
+
+    def log_hyperparams(self, params, *args, **kwargs):
+        params = params if isinstance(params, dict) else vars(params)
+        self.sink.log({"hyperparameters": {key: str(value) for key, value in params.items()}})
+
+    def log_metrics(self, metrics, step=None):
+        self.sink.log(dict(metrics, step=step))
+
+    def finalize(self, status):
+        # Lightning finalizes after fit and may log again for test, so only flush here
+        self.sink.flush()
+
+def benchmark_metric_overhead(model, batch, steps=50):
+    """
+    Milliseconds per training step with per-step .item() metrics against RunningMetrics.
+
+    Both variants run the same forward, backward and optimizer step on one batch (with a
+    throwaway optimizer), so the difference is the cost of synchronising every step.
+    """
+    device = next(model.parameters()).device
+    inputs, labels = batch[0].to(device), batch[1].to(device)
+    optimizer = optim.SGD(model.parameters(), lr=0.0)
+    model.train()
+
+    def step():
+        optimizer.zero_grad()
+        outputs = model(inputs)
+        loss = F.cross_entropy(outputs, labels)
+        loss.backward()
+        optimizer.step()
+        return loss, outputs
+
+    def synchronising_steps():
+        running_loss, correct = 0.0, 0
+        for _ in range(steps):
+            loss, outputs = step()
+            running_loss += loss.item()
+            correct += (outputs.argmax(dim=1) == labels).sum().item()
+
+    def on_device_steps():
+        running_metrics = RunningMetrics(device)
+        for _ in range(steps):
+            loss, outputs = step()
+            running_metrics.update(loss, outputs, labels)
+        running_metrics.compute()
+
+    rows = []
+    for name, function in (("per-step .item()", synchronising_steps), ("RunningMetrics", on_device_steps)):
+        function()  # warm-up
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        function()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        rows.append({"metrics": name, "ms_per_step": 1000 * (time.perf_counter() - start) / steps})
+    return pd.DataFrame(rows)
+
+class TrainingThroughputMonitor:
+    """
+    Per-step breakdown of training time: loader wait, collate, forward, backward and optimizer.
+
+    Manual loop:
+        for batch in monitor.wrap_loader(loader):  # times the wait for the batch and starts the step
+            ... forward ...; monitor.mark("forward")
+            ... backward ...; monitor.mark("backward")
+            ... optimizer step ...; monitor.mark("optimizer")
+            monitor.end_step(batch_size)
+        report = monitor.epoch_report()
+
+    On CUDA the phases are timed with CUDA events that are only read back in
+    step_records(), so the instrumentation adds no synchronisation; on CPU host
+    timestamps are used. Collate time is measured inside CustomDataModule.collate_function
+    (set data_module.throughput_monitor), in DataLoader worker processes too through a
+    shared counter, and is attributed to the step during which it was produced. An
+    epoch is flagged input-bound when the loader wait exceeds input_bound_fraction of
+    the step time (host wall time, including the wait). The shared counter only reaches
+    forked workers; spawn/forkserver workers (macOS, Windows) pickle the monitor with the
+    collate_fn and count into their own copy, so collate_s then covers in-process collation only.
+    """
+
+    def __init__(self, device, input_bound_fraction=0.2):
+        self.use_cuda_events = torch.device(device).type == "cuda"
+        self.input_bound_fraction = input_bound_fraction
+        self.collate_seconds = multiprocessing.Value("d", 0.0)
+        self.reset()
+
+    def __getstate__(self):
+        # Synchronized values cannot be pickled and CUDA events need not travel to a worker
+        state = dict(self.__dict__, steps=[], current=None)
+        del state["collate_seconds"]
+        return state
+
+    def __setstate__(self, state):
+        # Unpickled in a spawn/forkserver worker: a per-worker counter the main process does not read
+        self.__dict__.update(state)
+        self.collate_seconds = multiprocessing.Value("d", 0.0)
+
+    def reset(self):
+        # Start a new epoch
+        self.steps = []
+        self.current = None
+        self.collate_seen = self.collate_seconds.value
+
+    @contextlib.contextmanager
+    def collate_timer(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.collate_seconds.get_lock():
+                self.collate_seconds.value += time.perf_counter() - start
+
+    def timestamp(self):
+        if self.use_cuda_events:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def begin_step(self, data_wait):
+        collate_total = self.collate_seconds.value
+        self.current = {"data_wait": data_wait, "collate": collate_total - self.collate_seen,
+                        "host_start": time.perf_counter(), "marks": [("start", self.timestamp())]}
+        self.collate_seen = collate_total
+
+    def mark(self, phase):
+        # End of a phase ("forward", "backward", "optimizer") of the current step
+        self.current["marks"].append((phase, self.timestamp()))
+
+    def end_step(self, num_samples):
+        self.current["samples"] = num_samples
+        self.current["host_end"] = time.perf_counter()
+        self.steps.append(self.current)
+        self.current = None
+
+    def wrap_loader(self, dataloader):
+        iterator = iter(dataloader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.begin_step(time.perf_counter() - start)
+            yield batch
+
+    def elapsed(self, start, end):
+        if self.use_cuda_events:
+            return start.elapsed_time(end) / 1000
+        return end - start
+
+    def step_records(self):
+        # One row per step, times in seconds
+        if self.use_cuda_events:
+            torch.cuda.synchronize()
+        records = []
+        for index, step in enumerate(self.steps):
+            record = {"step": index, "data_wait_s": step["data_wait"], "collate_s": step["collate"]}
+            for (_, start), (phase, end) in zip(step["marks"], step["marks"][1:]):
+                record[phase + "_s"] = record.get(phase + "_s", 0.0) + self.elapsed(start, end)
+            record["step_s"] = step["data_wait"] + step["host_end"] - step["host_start"]
+            record["samples"] = step["samples"]
+            record["samples_per_s"] = step["samples"] / max(record["step_s"], 1e-9)
+            records.append(record)
+        return pd.DataFrame(records)
+
+    def epoch_report(self):
+        # Epoch totals and means, with input_bound set when the loader wait dominates
+        records = self.step_records()
+        if records.empty:
+            return {}
+        total_seconds = records["step_s"].sum()
+        report = {"steps": len(records), "samples_per_s": records["samples"].sum() / max(total_seconds, 1e-9),
+                  "data_wait_fraction": records["data_wait_s"].sum() / max(total_seconds, 1e-9)}
+        for column in ("data_wait_s", "collate_s", "forward_s", "backward_s", "optimizer_s"):
+            if column in records:
+                report["mean_" + column] = float(records[column].mean())
+        report["input_bound"] = bool(report["data_wait_fraction"] > self.input_bound_fraction)
+        return report
+
+def describe_throughput(report):
+    # One-line summary of TrainingThroughputMonitor.epoch_report()
+    if not report:
+        return "no steps recorded"
+    line = "{:.1f} samples/s, loader wait {:.0%} of step time (collate {:.1f} ms, forward {:.1f} ms, " \
+           "backward {:.1f} ms, optimizer {:.1f} ms per step)".format(
+               report["samples_per_s"], report["data_wait_fraction"], 1000 * report.get("mean_collate_s", 0.0),
+               1000 * report.get("mean_forward_s", 0.0), 1000 * report.get("mean_backward_s", 0.0),
+               1000 * report.get("mean_optimizer_s", 0.0))
+    if report["input_bound"]:
+        line += " -- INPUT-BOUND: decode/collate cannot keep up, add workers, prefetching or the resampled cache"
+    return line
+
+class ThroughputCallback(pl.Callback):
+    """
+    TrainingThroughputMonitor for Lightning training.
+
+    The loader wait is the time from the end of one training batch to the start of the next
+    (it includes the host-to-device copy). Phases end at on_before_backward (forward),
+    on_after_backward (backward) and on_train_batch_end (optimizer step). The epoch report is
+    logged as throughput/* metrics and printed when training is input-bound.
+    """
+
+    def __init__(self, input_bound_fraction=0.2):
+        self.input_bound_fraction = input_bound_fraction
+        self.monitor = None
+        self.batch_end_time = None
+
+    def on_fit_start(self, trainer, pl_module):
+        self.monitor = TrainingThroughputMonitor(pl_module.device, self.input_bound_fraction)
+        if hasattr(trainer.datamodule, "throughput_monitor"):
+            trainer.datamodule.throughput_monitor = self.monitor
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self.monitor.reset()
+        self.batch_end_time = time.perf_counter()
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+        self.monitor.begin_step(time.perf_counter() - self.batch_end_time)
+
+    def on_before_backward(self, trainer, pl_module, loss):
+        self.monitor.mark("forward")
+
+    def on_after_backward(self, trainer, pl_module):
+        self.monitor.mark("backward")
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        self.monitor.mark("optimizer")
+        self.monitor.end_step(len(batch[1]))
+        self.batch_end_time = time.perf_counter()
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        report = self.monitor.epoch_report()
+        if not report:
+            return
+        pl_module.log_dict({"throughput/" + key: float(value) for key, value in report.items()})
+        if report["input_bound"]:
+            print("Epoch {}: {}".format(trainer.current_epoch, describe_throughput(report)))
+
 # Define the number of classes
 num_classes = 10
 
@@ -293,6 +1850,10 @@ model = Conv1DClassifier(num_classes).to(device)
 # Print model summary
 summary(model, (1, 144000))
 
+# Window-level batching (set window_batching=True on the data module); the training loop and
+# evaluate_split run it through forward_batch:
+#model = WindowLevelClassifier(Conv1DWindowClassifier(num_classes)).to(device)
+
 # Define loss function
 criterion = nn.CrossEntropyLoss()
 
@@ -302,125 +1863,111 @@ optimizer = optim.Adam(model.parameters(), lr=0.01)
 # Define number of epochs
 num_epochs = 100
 
+# Loader stall removed by thread-pool prefetching over one training pass (uncomment to measure)
+# (forward and backward only: the step must leave the model and optimizer untouched)
+#def train_step(batch):
+#    criterion(model(batch[0].to(device)), batch[1].to(device)).backward()
+#    model.zero_grad(set_to_none=True)
+#print(compare_loader_stall(custom_data_module.training_dataset, custom_data_module.collate_function, train_step))
+
 """WandB"""
 
 !pip install wandb -qU
 
 import wandb
-wandb.login()
+use_wandb = False  # WandB needs network access; metrics always go to the local sink below
+if use_wandb:
+    wandb.login()
 
-#wandb.init(project="dl_assignment_2")
-wandb.init(project='dl_assignment_2', name='training_run')
+    #wandb.init(project="dl_assignment_2")
+    wandb.init(project='dl_assignment_2', name='training_run')
 
-# Training loop
+metric_sink = LocalMetricSink('./logs/conv1d_metrics.jsonl')
+#print(benchmark_metric_overhead(model, next(iter(custom_data_module.train_dataloader()))))  # per-step cost before/after
+
+# Loader wait / collate / forward / backward / optimizer time per step
+throughput_monitor = TrainingThroughputMonitor(device)
+custom_data_module.throughput_monitor = throughput_monitor
+
+# Training loop (one DataLoader for all epochs)
+train_loader = custom_data_module.train_dataloader()
+running_metrics = RunningMetrics(device)  # stays on the device until the epoch ends
 for epoch in range(num_epochs):
     model.train()  # Set the model to training mode
-    running_loss = 0.0
-    correct = 0
-    total = 0
+    running_metrics.reset()
+    throughput_monitor.reset()
 
-    for data in custom_data_module.train_dataloader():
-        inputs, labels = data[0].to(device), data[1].to(device)
+    for data in throughput_monitor.wrap_loader(train_loader):
+        data = [tensor.to(device) for tensor in data]
+        labels = data[1]
         optimizer.zero_grad()
-        outputs = model(inputs)
+        outputs = forward_batch(model, data)  # window batches: per-window logits reduced by clip_index
         loss = criterion(outputs, labels)
+        throughput_monitor.mark("forward")
         loss.backward()
+        throughput_monitor.mark("backward")
         optimizer.step()
+        throughput_monitor.mark("optimizer")
 
-        running_loss += loss.item()
-        _, predicted = torch.max(outputs, 1)
-        total += labels.size(0)
-        correct += (predicted == labels).sum().item()
+        running_metrics.update(loss, outputs, labels)
+        throughput_monitor.end_step(labels.size(0))
 
-    epoch_loss = running_loss / len(custom_data_module.train_dataloader())
-    epoch_accuracy = 100 * correct / total
+    epoch_metrics = running_metrics.compute()  # the only sync of the epoch
+    epoch_loss = epoch_metrics["loss"]
+    epoch_accuracy = epoch_metrics["accuracy"]
+    throughput_report = throughput_monitor.epoch_report()
 
-    # Log loss and accuracy with WandB
-    wandb.log({"Train Loss": epoch_loss, "Train Accuracy": epoch_accuracy}, step=epoch)
+    # Log loss and accuracy
+    metric_sink.log({"epoch": epoch, "Train Loss": epoch_loss, "Train Accuracy": epoch_accuracy,
+                     **{"throughput/" + key: value for key, value in throughput_report.items()}})
+    if throughput_report.get("input_bound"):
+        print(describe_throughput(throughput_report))
+    if use_wandb:
+        wandb.log({"Train Loss": epoch_loss, "Train Accuracy": epoch_accuracy}, step=epoch)
 
     print(f"Epoch [{epoch + 1}/{num_epochs}], Loss: {epoch_loss:.4f}, Accuracy: {epoch_accuracy:.2f}%")
 
 
-# Calculate accuracy on the training set
-model.eval()  # Set the model to evaluation mode
-correct = 0
-total = 0
+# One inference pass per split; accuracy, confusion matrix, report and ROC all come from the stored logits
+evaluations = {split: evaluate_split(model, dataloader, num_classes, device) for split, dataloader in
+               (("train", custom_data_module.train_dataloader()),
+                ("validation", custom_data_module.val_dataloader()),
+                ("test", custom_data_module.test_dataloader()))}
 
-with torch.no_grad():
-    for data in custom_data_module.train_dataloader():
-        inputs, labels = data[0].to(device), data[1].to(device)  # Move data to GPU if available
-        outputs = model(inputs)
-        _, predicted = torch.max(outputs, 1)
-        total += labels.size(0)
-        correct += (predicted == labels).sum().item()
-
-train_accuracy = 100 * correct / total
+# Calculate accuracy on the training set
+train_accuracy = 100 * evaluations["train"].accuracy().item()
 
-# Log final training accuracy with WandB
-wandb.log({"Final Train Accuracy": train_accuracy})
+# Log final training accuracy
+metric_sink.log({"Final Train Accuracy": train_accuracy})
+if use_wandb:
+    wandb.log({"Final Train Accuracy": train_accuracy})
 
 print(f"Accuracy on the training set: {train_accuracy:.2f}%")
 
-wandb.finish()  # Finish WandB logging at the end of training
+metric_sink.close()  # Flush the local metric log
+if use_wandb:
+    wandb.finish()  # Finish WandB logging at the end of training
 
 # Calculate accuracy on the validation set
-correct = 0
-total = 0
-
-with torch.no_grad():
-    for data in custom_data_module.val_dataloader():
-        inputs, labels = data[0].to(device), data[1].to(device)  # Move data to GPU if available
-        outputs = model(inputs)
-        _, predicted = torch.max(outputs, 1)
-        total += labels.size(0)
-        correct += (predicted == labels).sum().item()
-
-val_accuracy = 100 * correct / total
+val_accuracy = 100 * evaluations["validation"].accuracy().item()
 print(f"Accuracy on the validation set: {val_accuracy:.2f}%")
 
 # Calculate accuracy on the test set
-correct = 0
-total = 0
-
-with torch.no_grad():
-    for data in custom_data_module.test_dataloader():
-        inputs, labels = data[0].to(device), data[1].to(device)  # Move data to GPU if available
-        outputs = model(inputs)
-        _, predicted = torch.max(outputs, 1)
-        total += labels.size(0)
-        correct += (predicted == labels).sum().item()
-
-test_accuracy = 100 * correct / total
+test_accuracy = 100 * evaluations["test"].accuracy().item()
 print(f"Accuracy on the test set: {test_accuracy:.2f}%")
 
 """Confusion,Roc plots"""
 
 import numpy as np
-from sklearn.metrics import accuracy_score, confusion_matrix, classification_report, roc_auc_score, roc_curve, auc
+from sklearn.metrics import classification_report, roc_auc_score
 import matplotlib.pyplot as plt
 
-# Set the model to evaluation mode
-model.eval()
-
-# Lists to store true labels and predicted labels
-true_labels = []
-predicted_probs = []
-
-with torch.no_grad():
-    for data in custom_data_module.test_dataloader():
-        inputs, labels = data[0].to(device), data[1].to(device)
-        outputs = model(inputs)
-        _, predicted = torch.max(outputs, 1)
-
-        true_labels.extend(labels.cpu().numpy())
-        predicted_probs.extend(torch.softmax(outputs, dim=1).cpu().numpy())
-
-# Convert lists to numpy arrays
-true_labels = np.array(true_labels)
-predicted_probs = np.array(predicted_probs)
+# True labels and predicted probabilities of the test pass above (no second sweep)
+true_labels = evaluations["test"].stored_labels().cpu().numpy()
+predicted_probs = evaluations["test"].probabilities().cpu().numpy()
 
 # Confusion Matrix
-conf_matrix = confusion_matrix(true_labels, np.argmax(predicted_probs, axis=1))
+conf_matrix = evaluations["test"].confusion_matrix().numpy()
 print("Confusion Matrix:")
 print(conf_matrix)
 
@@ -431,14 +1978,20 @@ print(class_report)
 
 # AUC-ROC Curve
 num_classes = 10
-fpr = dict()
-tpr = dict()
-roc_auc = dict()
 
-# Compute ROC curve and ROC area for each class
-for i in range(num_classes):
-    fpr[i], tpr[i], _ = roc_curve((true_labels == i).astype(int), predicted_probs[:, i])
-    roc_auc[i] = auc(fpr[i], tpr[i])
+# Binned per-class ROC from probability histograms (for very large sets stream instead of storing logits:
+# evaluate_split(model, loader, num_classes, device, evaluation=StreamingEvaluation(num_classes)))
+test_roc = BinnedROCAccumulator(num_classes, num_bins=1000).update(evaluations["test"].probabilities(),
+                                                                   evaluations["test"].stored_labels())
+binned_fpr, binned_tpr = test_roc.roc_curves()
+fpr = dict(enumerate(binned_fpr.numpy()))
+tpr = dict(enumerate(binned_tpr.numpy()))
+roc_auc = dict(enumerate(test_roc.roc_auc().tolist()))
+
+# Binned AUC against the exact sklearn figure, within the documented bound
+exact_auc = np.array([roc_auc_score((true_labels == i).astype(int), predicted_probs[:, i]) for i in range(num_classes)])
+print("Max binned AUC deviation: ", np.abs(np.array([roc_auc[i] for i in range(num_classes)]) - exact_auc).max(),
+      " bound: ", test_roc.auc_error_bound().max().item())
 
 # Plot ROC curve
 plt.figure(figsize=(10, 6))
@@ -476,7 +2029,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import pytorch_lightning as pl
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, TensorDataset
 
 # Define the Convolutional Base
 class ConvolutionalBase(nn.Module):
@@ -514,37 +2067,38 @@ class ConvolutionalBase(nn.Module):
         return x
 
 class ConvolutionalBase1(nn.Module):
-    def __init__(self, embed_size):
+    def __init__(self, embed_size, ceil_mode=False):
         super(ConvolutionalBase1, self).__init__()
         self.conv1 = nn.Conv1d(in_channels=1, out_channels=32, kernel_size=11, stride=5, padding=5)
         self.conv2 = nn.Conv1d(in_channels=32, out_channels=64, kernel_size=9, stride=5, padding=4)
         self.conv3 = nn.Conv1d(in_channels=64, out_channels=128, kernel_size=7, stride=3, padding=3)
         self.conv4 = nn.Conv1d(in_channels=128, out_channels=256, kernel_size=5, stride=2, padding=2)
         self.conv5 = nn.Conv1d(in_channels=256, out_channels=512, kernel_size=3, stride=1, padding=1)
-        self.pool = nn.MaxPool1d(kernel_size=3, stride=3)
+        self.pool = nn.MaxPool1d(kernel_size=3, stride=3, ceil_mode=ceil_mode)  # ceil_mode for pooled heads on short inputs
         self.embed_size = embed_size
 
-    def forward(self, x):
+    def forward(self, x, lengths=None):
+        # lengths: (batch_size,) valid samples of each clip in a zero-padded batch, or None
         # Input dimension: (batch_size, 1, 144000)
-        x = F.relu(self.conv1(x))
+        x, lengths = mask_past_length(F.relu(self.conv1(x)), self.conv1, lengths)
         # Dimension after conv1: (batch_size, 32, 28800)
-        x = self.pool(x)
+        x, lengths = mask_past_length(self.pool(x), self.pool, lengths)
         # Dimension after pooling: (batch_size, 32, 9600)
-        x = F.relu(self.conv2(x))
+        x, lengths = mask_past_length(F.relu(self.conv2(x)), self.conv2, lengths)
         # Dimension after conv2: (batch_size, 64, 1920)
-        x = self.pool(x)
+        x, lengths = mask_past_length(self.pool(x), self.pool, lengths)
         # Dimension after pooling: (batch_size, 64, 640)
-        x = F.relu(self.conv3(x))
+        x, lengths = mask_past_length(F.relu(self.conv3(x)), self.conv3, lengths)
         # Dimension after conv3: (batch_size, 128, 214)
-        x = self.pool(x)
+        x, lengths = mask_past_length(self.pool(x), self.pool, lengths)
         # Dimension after pooling: (batch_size, 128, 71)
-        x = F.relu(self.conv4(x))
+        x, lengths = mask_past_length(F.relu(self.conv4(x)), self.conv4, lengths)
         # Dimension after conv4: (batch_size, 256, 36)
-        x = self.pool(x)
+        x, lengths = mask_past_length(self.pool(x), self.pool, lengths)
         # Dimension after pooling: (batch_size, 256, 12)
-        x = F.relu(self.conv5(x))
+        x, lengths = mask_past_length(F.relu(self.conv5(x)), self.conv5, lengths)
         # Dimension after conv5: (batch_size, 512, 12)
-        x = self.pool(x)
+        x, lengths = mask_past_length(self.pool(x), self.pool, lengths)
         # Dimension after pooling: (batch_size, 512, 4)
 
         # Reshape the tensor to match the expected input shape for the Transformer
@@ -552,41 +2106,307 @@ class ConvolutionalBase1(nn.Module):
         x = x.view(-1, x.size(1), self.embed_size)  # Reshape to (batch_size, seq_length, embed_size)
         return x
 
+    def output_length(self, length):
+        # Number of tokens produced for inputs of the given length (int or tensor of lengths)
+        for layer in (self.conv1, self.pool, self.conv2, self.pool, self.conv3, self.pool,
+                      self.conv4, self.pool, self.conv5, self.pool):
+            length = conv_output_length(length, layer)
+        return length
+
+def conv_output_length(length, layer):
+    # Output length of a Conv1d or MaxPool1d layer (dilation 1) for an input of the given length
+    kernel_size, stride, padding = (value[0] if isinstance(value, tuple) else value
+                                    for value in (layer.kernel_size, layer.stride, layer.padding))
+    if getattr(layer, "ceil_mode", False):
+        return -(-(length + 2 * padding - kernel_size) // stride) + 1
+    return (length + 2 * padding - kernel_size) // stride + 1
+
+def mask_past_length(x, layer, lengths):
+    """
+    Zero the activations of a (batch_size, channels, positions) layer output past each clip's end.
+
+    lengths are the valid input lengths of the layer (None: unpadded batch, nothing to do).
+    Past a clip's end, zero padding still goes through the conv bias and ReLU, and a
+    pooling window across the end mixes it into the last real position; zeroing after
+    every conv and pool makes the clip's features the ones it gets when run alone (conv
+    padding is zeros, and the ReLU outputs a partial ceil_mode window sees are >= 0).
+
+    Returns:
+        The masked output and the valid output lengths.
+    """
+    if lengths is None:
+        return x, None
+    lengths = conv_output_length(lengths, layer)
+    return x.masked_fill(torch.arange(x.size(-1), device=x.device) >= lengths.view(-1, 1, 1), 0.0), lengths
+
+class ContiguousConvolutionalBase1(ConvolutionalBase1):
+    """
+    Overlap-aware frontend with the same layers (and state_dict keys) as ConvolutionalBase1.
+
+    The collated input concatenates half-overlapping windows, so conv1 and conv2
+    process every sample twice. This frontend rebuilds the contiguous clip from the
+    windows, runs conv1 -> pool -> conv2 -> pool once over it, and gathers, for every
+    position of the concatenated layout, the feature at the same clip position.
+    conv3 onwards run as in ConvolutionalBase1, so the token shape is unchanged.
+    conv1 and conv2 are about two thirds of the conv MACs and now cover 80000
+    instead of 144000 samples per 5 s clip.
+
+    Deviation from ConvolutionalBase1: a gathered position is snapped to the nearest
+    contiguous feature (at most half the 225-sample stride away), and features next
+    to a window boundary see the neighbouring audio instead of the junction with the
+    adjacent window. Slicing the final feature map per window is not possible, as its
+    36450-sample stride is longer than a window. The tokens are therefore not those of
+    ConvolutionalBase1 (around 17% relative deviation, see frontend_deviation): a
+    ConvolutionalBase1 checkpoint loads, but is only a starting point to fine-tune from.
+    """
+
+    def __init__(self, embed_size, window_size, step_size, ceil_mode=False):
+        super(ContiguousConvolutionalBase1, self).__init__(embed_size, ceil_mode)
+        self.window_size = window_size
+        self.step_size = step_size
+
+    def forward(self, x, lengths=None):
+        # Input dimension: (batch_size, 1, num_windows * window_size)
+        # lengths: (batch_size,) valid samples (whole windows) of each clip in a zero-padded batch, or None
+        batch_size, channels, length = x.shape
+        num_windows = length // self.window_size
+        windows = x.view(batch_size, channels, num_windows, self.window_size)
+        # Contiguous clip: the first window plus the new samples of every following window
+        clip = torch.cat([windows[:, :, 0], windows[:, :, 1:, self.window_size - self.step_size:].flatten(2)], dim=2)
+
+        clip_lengths = None
+        if lengths is not None:
+            clip_lengths = self.window_size + (lengths // self.window_size - 1) * self.step_size
+        features, clip_lengths = mask_past_length(F.relu(self.conv1(clip)), self.conv1, clip_lengths)
+        features, clip_lengths = mask_past_length(self.pool(features), self.pool, clip_lengths)
+        features, clip_lengths = mask_past_length(F.relu(self.conv2(features)), self.conv2, clip_lengths)
+        features, clip_lengths = mask_past_length(self.pool(features), self.pool, clip_lengths)
+
+        # Positions ConvolutionalBase1 would produce after the second pooling, mapped onto the clip
+        target_length = length
+        for layer in (self.conv1, self.pool, self.conv2, self.pool):
+            target_length = conv_output_length(target_length, layer)
+        stride = self.conv1.stride[0] * self.pool.stride * self.conv2.stride[0] * self.pool.stride
+        offsets = torch.arange(target_length, device=x.device) * stride
+        window_index = torch.div(offsets, self.window_size, rounding_mode="floor").clamp(max=num_windows - 1)
+        clip_offsets = window_index * self.step_size + offsets - window_index * self.window_size
+        positions = torch.div(clip_offsets + stride // 2, stride, rounding_mode="floor").clamp(max=features.size(-1) - 1)
+        if lengths is None:
+            x = features.index_select(2, positions)
+        else:
+            # Snap to the clip's own last feature, as the clip run alone would
+            positions = torch.minimum(positions, (clip_lengths - 1).clamp(min=0).unsqueeze(1))
+            x = features.gather(2, positions.unsqueeze(1).expand(-1, features.size(1), -1))
+            for layer in (self.conv1, self.pool, self.conv2, self.pool):
+                lengths = conv_output_length(lengths, layer)
+            x = x.masked_fill(torch.arange(x.size(-1), device=x.device) >= lengths.view(-1, 1, 1), 0.0)
+
+        x, lengths = mask_past_length(F.relu(self.conv3(x)), self.conv3, lengths)
+        x, lengths = mask_past_length(self.pool(x), self.pool, lengths)
+        x, lengths = mask_past_length(F.relu(self.conv4(x)), self.conv4, lengths)
+        x, lengths = mask_past_length(self.pool(x), self.pool, lengths)
+        x, lengths = mask_past_length(F.relu(self.conv5(x)), self.conv5, lengths)
+        x, lengths = mask_past_length(self.pool(x), self.pool, lengths)
+        # Dimension after pooling: (batch_size, 512, 4)
+
+        x = x.permute(0, 2, 1)  # Permute dimensions to (batch_size, seq_length, channels)
+        x = x.view(-1, x.size(1), self.embed_size)  # Reshape to (batch_size, seq_length, embed_size)
+        return x
+
+def frontend_deviation(conv_base, x, window_size, step_size):
+    # Largest absolute and relative token difference of the contiguous frontend on a batch
+    contiguous_base = ContiguousConvolutionalBase1(conv_base.embed_size, window_size, step_size).to(x.device)
+    contiguous_base.load_state_dict(conv_base.state_dict())
+    with torch.no_grad():
+        reference, contiguous = conv_base(x), contiguous_base(x)
+    difference = (reference - contiguous).abs().max().item()
+    return difference, difference / reference.abs().max().clamp(min=1e-12).item()
+
 
 
 # Define MultiHead Self-Attention Block
 class MultiHeadSelfAttention(nn.Module):
-    def __init__(self, d_model, num_heads):
+    # "reference": explicit matmul/softmax, "sdpa": fused scaled_dot_product_attention,
+    # "chunked": reference maths over query chunks, O(chunk_size * seq_length) score memory.
+    # Linear-time variants for long recordings (a different model, train with them):
+    # "linear": kernelized attention with an elu + 1 feature map,
+    # "local": softmax attention restricted to the query's block and its two neighbours
+    backends = ("reference", "sdpa", "chunked", "linear", "local")
+
+    def __init__(self, d_model, num_heads, backend="reference", chunk_size=1024, project_query=False, local_window=128):
         super(MultiHeadSelfAttention, self).__init__()
         self.num_heads = num_heads
         self.d_model = d_model
         assert d_model % num_heads == 0
+        if backend not in self.backends:
+            raise ValueError("unknown attention backend {!r}, expected one of {}".format(backend, self.backends))
         self.depth = d_model // num_heads
+        self.scale = 1.0 / math.sqrt(self.depth)
+        self.backend = backend
+        self.chunk_size = chunk_size
+        self.local_window = local_window
+        # Trained checkpoints never applied W_q to the query, so it stays opt-in
+        self.project_query = project_query
         self.W_q = nn.Linear(d_model, d_model)
         self.W_k = nn.Linear(d_model, d_model)
         self.W_v = nn.Linear(d_model, d_model)
         self.W_out = nn.Linear(d_model, d_model)
 
-    def forward(self, query, key, value):
+    def forward(self, query, key, value, key_padding_mask=None):
+        # key_padding_mask: (batch_size, seq_length), True for padded keys that must not be attended
         batch_size = query.shape[0]
-        query = query
+        if self.project_query:
+            query = self.W_q(query)
         key = self.W_k(key)
         value = self.W_v(value)
-        query = query.view(batch_size, -1, self.num_heads, self.depth).transpose(1, 2)
+        query = query.reshape(batch_size, -1, self.num_heads, self.depth).transpose(1, 2)
         key = key.view(batch_size, -1, self.num_heads, self.depth).transpose(1, 2)
         value = value.view(batch_size, -1, self.num_heads, self.depth).transpose(1, 2)
-        scores = torch.matmul(query, key.transpose(-2, -1)) / torch.sqrt(torch.tensor(self.depth, dtype=torch.float32))
-        attention_weights = F.softmax(scores, dim=-1)
-        attention_output = torch.matmul(attention_weights, value)
+        if self.backend == "sdpa":
+            attention_mask = None if key_padding_mask is None else ~key_padding_mask[:, None, None, :]
+            attention_output = F.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask)
+        elif self.backend == "chunked":
+            attention_output = self.chunked_attention(query, key, value, key_padding_mask)
+        elif self.backend == "linear":
+            attention_output = self.linear_attention(query, key, value, key_padding_mask)
+        elif self.backend == "local":
+            attention_output = self.local_attention(query, key, value, key_padding_mask)
+        else:
+            attention_output = self.reference_attention(query, key, value, key_padding_mask)
         attention_output = attention_output.transpose(1, 2).contiguous().view(batch_size, -1, self.d_model)
         attention_output = self.W_out(attention_output)
         return attention_output
 
+    def reference_attention(self, query, key, value, key_padding_mask=None):
+        scores = torch.matmul(query, key.transpose(-2, -1)) * self.scale
+        if key_padding_mask is not None:
+            scores = scores.masked_fill(key_padding_mask[:, None, None, :], torch.finfo(scores.dtype).min)
+        attention_weights = F.softmax(scores, dim=-1)
+        return torch.matmul(attention_weights, value)
+
+    def chunked_attention(self, query, key, value, key_padding_mask=None):
+        # Only a (chunk_size, seq_length) block of scores per head is alive at a time
+        return torch.cat([self.reference_attention(query_chunk, key, value, key_padding_mask)
+                          for query_chunk in query.split(self.chunk_size, dim=2)], dim=2)
+
+    def linear_attention(self, query, key, value, key_padding_mask=None):
+        # phi(q) (phi(k)^T v) / phi(q) sum(phi(k)): never materialises the (seq, seq) score matrix
+        query = F.elu(query) + 1
+        key = F.elu(key) + 1
+        if key_padding_mask is not None:
+            key = key.masked_fill(key_padding_mask[:, None, :, None], 0.0)
+        key_value = torch.einsum("bhnd,bhne->bhde", key, value)
+        normalizer = torch.einsum("bhnd,bhd->bhn", query, key.sum(dim=2)).clamp(min=1e-6)
+        return torch.einsum("bhnd,bhde->bhne", query, key_value) / normalizer.unsqueeze(-1)
+
+    def local_attention(self, query, key, value, key_padding_mask=None):
+        # Queries of each block of local_window tokens attend to that block and its two neighbours
+        batch_size, num_heads, length, depth = query.shape
+        block = min(self.local_window, length)
+        pad = (-length) % block
+        num_blocks = (length + pad) // block
+        query = F.pad(query, (0, 0, 0, pad)).view(batch_size, num_heads, num_blocks, block, depth)
+
+        def neighbourhoods(tensor):
+            # (batch, heads, num_blocks, 3 * block, depth): previous, own and next block of keys
+            tensor = F.pad(tensor, (0, 0, block, pad + block)).view(batch_size, num_heads, num_blocks + 2, block, depth)
+            return torch.cat([tensor[:, :, :-2], tensor[:, :, 1:-1], tensor[:, :, 2:]], dim=3)
+
+        key, value = neighbourhoods(key), neighbourhoods(value)
+        scores = torch.matmul(query, key.transpose(-2, -1)) * self.scale
+        # Mask the zero padding before the first and after the last token
+        positions = (torch.arange(num_blocks, device=query.device).unsqueeze(1) - 1) * block \
+            + torch.arange(3 * block, device=query.device)
+        scores = scores.masked_fill(((positions < 0) | (positions >= length))[:, None, :], float("-inf"))
+        if key_padding_mask is not None:
+            # Finite fill: a padded query whose whole neighbourhood is padding must not turn into NaN
+            padding = F.pad(key_padding_mask, (block, pad + block), value=True).view(batch_size, num_blocks + 2, block)
+            padding = torch.cat([padding[:, :-2], padding[:, 1:-1], padding[:, 2:]], dim=2)
+            scores = scores.masked_fill(padding[:, None, :, None, :], torch.finfo(scores.dtype).min)
+        attention_output = torch.matmul(F.softmax(scores, dim=-1), value)
+        return attention_output.view(batch_size, num_heads, num_blocks * block, depth)[:, :, :length]
+
+def check_attention_backends(d_model=512, num_heads=4, seq_length=100, batch_size=2, chunk_size=16, atol=1e-4):
+    # Largest absolute deviation of the exact backends from the reference path on random tokens
+    # ("local" is exact once its window covers the sequence; "linear" approximates by design)
+    attention = MultiHeadSelfAttention(d_model, num_heads, chunk_size=chunk_size, local_window=seq_length).eval()
+    x = torch.randn(batch_size, seq_length, d_model)
+    errors = {}
+    with torch.no_grad():
+        expected = attention(x, x, x)
+        for backend in ("sdpa", "chunked", "local"):
+            attention.backend = backend
+            errors[backend] = (attention(x, x, x) - expected).abs().max().item()
+    if max(errors.values()) > atol:
+        raise AssertionError("attention backends deviate from the reference: {}".format(errors))
+    return errors
+
+def peak_memory_mb(function):
+    # Peak CUDA memory of a call; on CPU the largest operator allocation seen by the profiler
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        function()
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated() / 1024 ** 2
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as profiler:
+        function()
+    return max((event.cpu_memory_usage for event in profiler.events()), default=0) / 1024 ** 2
+
+def time_call(function, repeats=10):
+    # Median wall-clock seconds of a call after one warm-up run
+    function()
+    timings = []
+    for _ in range(repeats):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        function()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+def benchmark_attention_backends(seq_lengths=(5, 64, 256, 1024, 4096), head_counts=(1, 2, 4), backends=None,
+                                 d_model=512, batch_size=4, repeats=10, max_quadratic_tokens=4096):
+    """
+    Latency and peak memory of the attention backends across sequence lengths and head counts.
+
+    "reference" and "sdpa" (which may fall back to a full score matrix) are skipped above
+    max_quadratic_tokens: at 16384 tokens and 4 heads their scores and softmax alone take
+    about 8 GiB, more than a standard Colab runtime has.
+
+    Returns:
+        A DataFrame with one row per (num_heads, seq_length, backend).
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    rows = []
+    for num_heads in head_counts:
+        attention = MultiHeadSelfAttention(d_model, num_heads).to(device).eval()
+        for seq_length in seq_lengths:
+            x = torch.randn(batch_size, seq_length, d_model, device=device)
+            for backend in backends or attention.backends:
+                if backend in ("reference", "sdpa") and seq_length > max_quadratic_tokens:
+                    continue
+                attention.backend = backend
+                with torch.no_grad():
+                    rows.append({"num_heads": num_heads, "seq_length": seq_length, "backend": backend,
+                                 "latency_ms": 1000 * time_call(lambda: attention(x, x, x), repeats),
+                                 "peak_memory_mb": peak_memory_mb(lambda: attention(x, x, x))})
+    return pd.DataFrame(rows)
+
+def benchmark_attention_scaling(token_counts=(256, 1024, 4096, 16384), backends=("reference", "chunked", "linear", "local"),
+                                num_heads=4, batch_size=1, repeats=3, max_quadratic_tokens=4096):
+    # Time and memory against token count for the quadratic and linear-time backends
+    # (the quadratic ones stop at max_quadratic_tokens)
+    return benchmark_attention_backends(seq_lengths=token_counts, head_counts=(num_heads,), backends=backends,
+                                        batch_size=batch_size, repeats=repeats, max_quadratic_tokens=max_quadratic_tokens)
+
 # Define Transformer Encoder Layer
 class TransformerEncoderLayer(nn.Module):
-    def __init__(self, d_model, num_heads):
+    def __init__(self, d_model, num_heads, attention_backend="reference"):
         super(TransformerEncoderLayer, self).__init__()
-        self.attention = MultiHeadSelfAttention(d_model, num_heads)
+        self.attention = MultiHeadSelfAttention(d_model, num_heads, backend=attention_backend)
         self.norm1 = nn.LayerNorm(d_model)
         self.feed_forward = nn.Sequential(
             nn.Linear(d_model, 2048),
@@ -595,8 +2415,8 @@ class TransformerEncoderLayer(nn.Module):
         )
         self.norm2 = nn.LayerNorm(d_model)
 
-    def forward(self, x):
-        x_att = self.attention(x, x, x)
+    def forward(self, x, key_padding_mask=None):
+        x_att = self.attention(x, x, x, key_padding_mask)
         x = self.norm1(x + x_att)
         x_ff = self.feed_forward(x)
         x = self.norm2(x + x_ff)
@@ -606,19 +2426,81 @@ class TransformerEncoderLayer(nn.Module):
 
 # Define Convolutional Transformer Classifier Model
 class ConvolutionalTransformerClassifier(pl.LightningModule):
-    def __init__(self, num_classes, d_model, num_heads, num_layers):
+    def __init__(self, num_classes, d_model, num_heads, num_layers, frontend="windows", window_size=16000, step_size=8000,
+                 attention_backend="reference", head="flatten"):
         super(ConvolutionalTransformerClassifier, self).__init__()
-        self.conv_base = ConvolutionalBase1(512)
+        # head="flatten" ties fc to exactly 4 conv tokens (144000 samples); "cls", "mean", "max" and
+        # "attention" pool the encoded tokens and accept any input length
+        self.head = head
+        self.num_classes = num_classes
+        ceil_mode = head != "flatten"
+        # frontend="contiguous" computes conv1/conv2 once per clip instead of once per overlapping window
+        # (different tokens, train or fine-tune with it; see frontend_deviation),
+        # frontend="cached" takes precomputed conv tokens (see ConvFeatureCache) as input
+        if frontend == "contiguous":
+            self.conv_base = ContiguousConvolutionalBase1(512, window_size, step_size, ceil_mode)
+        elif frontend == "cached":
+            self.conv_base = nn.Identity()
+        else:
+            self.conv_base = ConvolutionalBase1(512, ceil_mode)
+        # One attention backend for every layer, or a list with one backend per layer
+        attention_backends = [attention_backend] * num_layers if isinstance(attention_backend, str) else list(attention_backend)
+        if len(attention_backends) != num_layers:
+            raise ValueError("expected {} attention backends, got {}".format(num_layers, len(attention_backends)))
         self.transformer_layers = nn.ModuleList([
-            TransformerEncoderLayer(d_model, num_heads) for _ in range(num_layers)
+            TransformerEncoderLayer(d_model, num_heads, backend) for backend in attention_backends
         ])
         self.cls_token = nn.Parameter(torch.randn(1, d_model))  # Remove the last dimension from cls_token
-        self.fc = nn.Linear(2560, num_classes)  # Adjusted input size for fc layer #dmodel*4
-    def forward(self, x):
+        if head == "flatten":
+            self.fc = nn.Linear(2560, num_classes)  # Adjusted input size for fc layer #dmodel*4
+        else:
+            self.sequence_pool = SequencePool(d_model, head)
+            self.fc = nn.Linear(d_model, num_classes)
+
+    def input_lengths(self, padding_mask, input_length):
+        # Window padding mask (batch_size, max_windows) -> valid samples of every clip
+        if isinstance(self.conv_base, nn.Identity):
+            raise ValueError("padding masks need the conv frontend, cached tokens carry no window layout")
+        return (~padding_mask).sum(dim=1) * (input_length // padding_mask.size(1))
+
+    def token_padding_mask(self, padding_mask, input_length):
+        # Window padding mask (batch_size, max_windows) -> token padding mask (batch_size, 1 + seq_length);
+        # a token is padding once it lies past the conv output of the clip's real windows
+        valid_lengths = self.conv_base.output_length(self.input_lengths(padding_mask, input_length)).clamp(min=0)
+        seq_length = self.conv_base.output_length(input_length)
+        token_mask = torch.arange(seq_length, device=padding_mask.device) >= valid_lengths.unsqueeze(1)
+        # The cls token is never padding
+        return F.pad(token_mask, (1, 0), value=False)
+
+    def forward(self, x, padding_mask=None):
       # Display the dimension before processing
       #print(f"Input Dimension: {x.size()}")
 
-      x = self.conv_base(x)
+      # padding_mask (from padded_collate_function): (batch_size, max_windows), True for padded windows.
+      # The conv frontend zeroes activations past each clip and attention and pooling skip the padded
+      # tokens, so a clip's logits do not depend on the other clips of its batch (check_padding_invariance)
+      if padding_mask is not None:
+          if self.head == "flatten":
+              raise ValueError("padded batches need a pooled head, head=\"flatten\" expects a fixed length")
+          lengths = self.input_lengths(padding_mask, x.size(-1))
+          padding_mask = self.token_padding_mask(padding_mask, x.size(-1))
+          x = self.conv_base(x, lengths)
+      else:
+          x = self.conv_base(x)
+      return self.classify_tokens(x, padding_mask)
+
+    def batch_logits(self, batch):
+      # Clip logits of a collated batch; window batches (window_batching=True) are classified
+      # per window, like WindowLevelClassifier, and the window logits averaged per clip
+      x, y, *extra = batch
+      if is_window_batch(batch):
+          if self.head == "flatten":
+              raise ValueError("window batches need a pooled head, head=\"flatten\" expects 144000-sample clips")
+          return aggregate_window_logits(self(x), extra[0], y.size(0))
+      return self(x, *extra)
+
+    def classify_tokens(self, x, padding_mask=None):
+      # Encoder and head on (batch_size, seq_length, 512) conv tokens, shared with StreamingClassifier
       batch_size = x.size(0)
       cls_token = self.cls_token.expand(batch_size, -1, 512)  # Ensure cls_token matches the size along dimension 2
 
@@ -629,9 +2511,12 @@ class ConvolutionalTransformerClassifier(pl.LightningModule):
       #print(f"Concatenated Dimension: {x.size()}")
 
       for layer in self.transformer_layers:
-          x = layer(x)
+          x = layer(x, padding_mask)
       #print(x)
-      x = x.flatten(start_dim=1)  # Flatten the input tensor along the feature dimension
+      if self.head == "flatten":
+          x = x.flatten(start_dim=1)  # Flatten the input tensor along the feature dimension
+      else:
+          x = self.sequence_pool(x, padding_mask)  # Pool the tokens, independent of their number
       #x = x.reshape()
       x = self.fc(x)  # Pass through the fully connected layer
       return x
@@ -640,84 +2525,1362 @@ class ConvolutionalTransformerClassifier(pl.LightningModule):
 
 
     def training_step(self, batch, batch_idx):
-        x, y = batch
-        logits = self(x)
+        y = batch[1]
+        logits = self.batch_logits(batch)
         loss = F.cross_entropy(logits, y)
         self.log('train_loss', loss)
         return loss
 
+    # Validation and test logits go into a SplitEvaluation; accuracy is computed once per epoch from it
+    def on_validation_epoch_start(self):
+        self.validation_evaluation = SplitEvaluation(self.num_classes, dataloader_num_samples(self.trainer.val_dataloaders))
+
     def validation_step(self, batch, batch_idx):
-        x, y = batch
-        logits = self(x)
+        y = batch[1]
+        logits = self.batch_logits(batch)
         loss = F.cross_entropy(logits, y)
         self.log('val_loss', loss)
-        preds = torch.argmax(logits, dim=1)
-        acc = (preds == y).float().mean()
-        self.log('val_acc', acc)
+        self.validation_evaluation.update(logits, y)
+
+    def on_validation_epoch_end(self):
+        self.log('val_acc', self.validation_evaluation.accuracy())
+
+    def on_test_epoch_start(self):
+        self.test_evaluation = SplitEvaluation(self.num_classes, dataloader_num_samples(self.trainer.test_dataloaders))
 
     def test_step(self, batch, batch_idx):
-        x, y = batch
-        logits = self(x)
+        y = batch[1]
+        logits = self.batch_logits(batch)
         loss = F.cross_entropy(logits, y)
         self.log('test_loss', loss)
-        preds = torch.argmax(logits, dim=1)
-        acc = (preds == y).float().mean()
-        self.log('test_acc', acc)
+        self.test_evaluation.update(logits, y)
+
+    def on_test_epoch_end(self):
+        self.log('test_acc', self.test_evaluation.accuracy())
 
     def configure_optimizers(self):
         optimizer = torch.optim.Adam(self.parameters(), lr=1e-3)
         return optimizer
 
+def check_padding_invariance(model, collate_function, window_counts=(3, 9), window_size=16000, tolerance=1e-5):
+    """
+    Largest absolute logit difference of a short clip batched with longer clips versus run alone.
+
+    collate_function is CustomDataModule.padded_collate_function; model has a pooled head.
+    Raises an AssertionError past tolerance, i.e. when padding leaks into a clip's logits.
+    """
+    model = model.eval()
+    clips = [torch.randn(count, window_size) for count in window_counts]
+    with torch.no_grad():
+        examples, _, padding_mask = collate_function([(clip, 0) for clip in clips])
+        batched = model(examples, padding_mask)
+        deviation = 0.0
+        for index, clip in enumerate(clips):
+            examples, _, padding_mask = collate_function([(clip, 0)])
+            deviation = max(deviation, (model(examples, padding_mask)[0] - batched[index]).abs().max().item())
+    if deviation > tolerance:
+        raise AssertionError("padded clip logits deviate by {:.3g} from the clip run alone, tolerance {:.3g}"
+                             .format(deviation, tolerance))
+    return deviation
+
+def port_flatten_head_checkpoint(model, state_dict):
+    """
+    Load a checkpoint trained with head="flatten" into a pooled-head model of the same architecture.
+
+    The flattened classifier weight is summed over positions, which reproduces the flatten
+    head exactly when the features are constant over time and is otherwise an initialisation
+    for a short fine-tune. Conv and transformer weights are copied unchanged.
+
+    Returns:
+        The keys the checkpoint did not provide (e.g. the attention-pool scorer).
+    """
+    state_dict = dict(state_dict)
+    if isinstance(model, ConvolutionalTransformerClassifier):
+        # fc input is token-major: (tokens, d_model)
+        weight = state_dict["fc.weight"]
+        state_dict["fc.weight"] = weight.view(weight.size(0), -1, model.fc.in_features).sum(dim=1)
+    else:
+        # fc1 input is channel-major: (512, positions)
+        weight = state_dict["fc1.weight"]
+        state_dict["fc1.weight"] = weight.view(weight.size(0), model.fc1.in_features, -1).sum(dim=2)
+    missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False)
+    if unexpected_keys:
+        raise ValueError("checkpoint keys not used by the model: {}".format(unexpected_keys))
+    return missing_keys
+
+def module_fingerprint(module):
+    # SHA-256 over the names, shapes and values of a module's parameters and buffers
+    digest = hashlib.sha256()
+    for name, tensor in module.state_dict().items():
+        tensor = tensor.detach().cpu().contiguous()
+        digest.update(name.encode())
+        digest.update(str(tuple(tensor.shape)).encode())
+        digest.update(tensor.numpy().tobytes())
+    return digest.hexdigest()
+
+def conv_base_from_conv1d_classifier(conv1d_model):
+    # ConvolutionalBase1 carrying the conv1-conv5 weights of a trained Conv1DClassifier
+    conv_base = ConvolutionalBase1(512)
+    conv_base.load_state_dict({name: tensor for name, tensor in conv1d_model.state_dict().items()
+                               if name.startswith("conv")})
+    return conv_base
+
+def dataset_fingerprint(dataset):
+    # SHA-256 over a split's file names, labels and windowing: equal sizes with other clips get another key
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(dataset.file_names).tobytes())
+    digest.update(np.ascontiguousarray(dataset.labels, dtype=np.int64).tobytes())
+    digest.update(json.dumps([dataset.new_sampling_rate, dataset.window_size, dataset.step_size,
+                              dataset.random_crop_length]).encode())
+    return digest.hexdigest()
+
+class ConvFeatureCache:
+    """
+    On-disk cache of the tokens a frozen conv frontend produces, one (N, seq, 512) tensor per split.
+
+    Cache files are named after the frontend's weight fingerprint and the split's content
+    (dataset_fingerprint), so tokens are recomputed whenever the frontend weights, the
+    split membership or the windowing change; files of older keys are removed.
+    """
+
+    def __init__(self, cache_directory, conv_base):
+        self.cache_directory = Path(cache_directory)
+        self.cache_directory.mkdir(parents=True, exist_ok=True)
+        self.conv_base = conv_base
+        self.fingerprint = module_fingerprint(conv_base)
+
+    def tokens(self, split, dataloader, dataset):
+        """
+        Tokens and labels of a split, computed with the frozen frontend on a cache miss.
+
+        Args:
+            split: split name used in the cache file name
+            dataloader: unshuffled loader of (examples, labels) batches for the split
+            dataset: the split's CustomDataset, fingerprinted into the cache key
+        """
+        num_samples = len(dataset)
+        path = self.cache_directory / "{}-{}-{}.pt".format(split, self.fingerprint[:16], dataset_fingerprint(dataset)[:16])
+        if path.exists():
+            cached = torch.load(path)
+            if cached["labels"].size(0) == num_samples:
+                return cached["tokens"], cached["labels"]
+
+        device = next(self.conv_base.parameters()).device
+        self.conv_base.eval()
+        tokens, labels = [], []
+        with torch.no_grad():
+            for batch in tqdm(dataloader):
+                tokens.append(self.conv_base(batch[0].to(device)).cpu())
+                labels.append(batch[1])
+        tokens, labels = torch.cat(tokens), torch.cat(labels)
+
+        for stale_path in self.cache_directory.glob("{}-*.pt".format(split)):
+            stale_path.unlink()
+        torch.save({"tokens": tokens, "labels": labels}, path)
+        return tokens, labels
+
+class CachedTokenDataModule(pl.LightningDataModule):
+    def __init__(self, feature_cache, data_module, batch_size):
+        # Serve the cached conv tokens of every split of an already set up CustomDataModule
+        super().__init__()
+        # The cache stores one fixed-length token sequence per clip, as collate_function batches them
+        unsupported = [mode for mode in ("bucket_batching", "window_batching", "use_shards")
+                       if data_module.data_module_kwargs.get(mode)]
+        if unsupported:
+            raise ValueError("CachedTokenDataModule needs fixed-length per-clip batches from file datasets, "
+                             "the data module uses {}".format(", ".join(unsupported)))
+        self.feature_cache = feature_cache
+        self.data_module = data_module
+        self.batch_size = batch_size
+
+    def setup(self, stage=None):
+        # Define token datasets for training, validation, and testing during Lightning setup
+        if stage == 'fit' or stage is None:
+            self.training_dataset = self.token_dataset("train", self.data_module.training_dataset)
+            self.validation_dataset = self.token_dataset("val", self.data_module.validation_dataset)
+        if stage == 'test' or stage is None:
+            self.testing_dataset = self.token_dataset("test", self.data_module.testing_dataset)
+
+    def token_dataset(self, split, dataset):
+        dataloader = self.data_module.make_dataloader(dataset, batch_size=self.batch_size, shuffle=False)
+        return TensorDataset(*self.feature_cache.tokens(split, dataloader, dataset))
+
+    def train_dataloader(self):
+        return DataLoader(self.training_dataset, batch_size=self.batch_size, shuffle=True)
+
+    def val_dataloader(self):
+        return DataLoader(self.validation_dataset, batch_size=self.batch_size, shuffle=False)
+
+    def test_dataloader(self):
+        return DataLoader(self.testing_dataset, batch_size=32, shuffle=False)
+
+class StreamingLayer:
+    """
+    Incremental Conv1d (followed by ReLU) or MaxPool1d over a growing input.
+
+    Only the tail of the input that later outputs still need is kept (at most
+    kernel_size - 1 frames plus a partial stride), so every push processes new frames
+    only. Outputs that depend on the right padding or on ceil_mode's partial last
+    window are held back until flush() marks the end of the stream.
+    """
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.kernel_size, self.stride, self.padding = (value[0] if isinstance(value, tuple) else value
+                                                       for value in (layer.kernel_size, layer.stride, layer.padding))
+        self.ceil_mode = getattr(layer, "ceil_mode", False)
+        self.buffer = None
+
+    def reset(self):
+        self.buffer = None
+
+    def apply(self, x):
+        # The layer without padding, on frames that are already padded
+        if isinstance(self.layer, nn.Conv1d):
+            return F.relu(F.conv1d(x, self.layer.weight, self.layer.bias, self.stride))
+        return F.max_pool1d(x, self.kernel_size, self.stride)
+
+    def push(self, x):
+        if self.buffer is None:
+            self.buffer = x.new_zeros(x.size(0), x.size(1), self.padding)  # left padding of the stream
+        buffer = torch.cat([self.buffer, x], dim=2)
+        num_outputs = max((buffer.size(2) - self.kernel_size) // self.stride + 1, 0)
+        consumed = num_outputs * self.stride
+        self.buffer = buffer[:, :, consumed:]
+        if num_outputs == 0:
+            channels = self.layer.out_channels if isinstance(self.layer, nn.Conv1d) else x.size(1)
+            return x.new_zeros(x.size(0), channels, 0)
+        return self.apply(buffer[:, :, :consumed - self.stride + self.kernel_size])
+
+    def flush(self):
+        # End of stream: right padding, then the partial last window of a ceil_mode pool
+        output = self.push(self.buffer.new_zeros(self.buffer.size(0), self.buffer.size(1), self.padding))
+        if self.ceil_mode and self.buffer.size(2) > self.kernel_size - self.stride:
+            output = torch.cat([output, self.buffer.amax(dim=2, keepdim=True)], dim=2)
+        self.buffer = None
+        return output
+
+class StreamingClassifier:
+    """
+    Real-time inference for Conv1DClassifier and ConvolutionalTransformerClassifier.
+
+    Samples arrive as one contiguous mono stream at sampling_rate. Every step_size new
+    samples complete one window_size window of the models' concatenated-window input, and
+    that window goes through a StreamingLayer per conv and pooling layer, so no sample is
+    convolved twice. Every hop, the head classifies the last context_tokens conv tokens
+    (those of a context_windows-window clip, 5 s by default).
+
+    A token spans 36450 concatenated samples (about 1.14 s of audio), so a hop only emits
+    logits when at least one new token was produced since the last emission; with 1 s hops
+    about one hop in eight emits nothing instead of repeating the previous logits.
+
+    The tokens equal those of the offline forward over all windows so far, up to the last
+    few, which wait for more audio (see check_streaming_equality). They are not the tokens
+    of model(last 5 s): the token grid's phase is fixed by the start of the stream and
+    there is no zero padding at the clip edges, so the logits deviate from a per-hop 5 s
+    forward; benchmark_streaming_latency reports that deviation next to the latencies.
+    """
+
+    conv_layer_names = ("conv1", "pool", "conv2", "pool", "conv3", "pool", "conv4", "pool", "conv5", "pool")
+
+    def __init__(self, model, sampling_rate=16000, hop_seconds=1.0, window_size=16000, step_size=8000, context_windows=9):
+        conv_module = model.conv_base if isinstance(model, ConvolutionalTransformerClassifier) else model
+        if isinstance(conv_module, ContiguousConvolutionalBase1) or not isinstance(conv_module, (ConvolutionalBase1, Conv1DClassifier)):
+            raise ValueError("streaming needs the per-window conv frontend, got {}".format(type(conv_module).__name__))
+        self.model = model.eval()
+        self.hop_size = int(hop_seconds * sampling_rate)
+        self.window_size = window_size
+        self.step_size = step_size
+        self.layers = [StreamingLayer(getattr(conv_module, name)) for name in self.conv_layer_names]
+        self.context_tokens = context_windows * window_size
+        for layer in self.layers:
+            self.context_tokens = conv_output_length(self.context_tokens, layer.layer)
+        self.reset()
+
+    def reset(self):
+        # Start a new stream
+        for layer in self.layers:
+            layer.reset()
+        self.pending = torch.zeros(0)
+        self.window_tail = None
+        self.tokens = None
+        self.num_tokens = 0
+        self.emitted_tokens = 0  # num_tokens at the last emission
+        self.hop_samples = 0
+
+    def push(self, samples):
+        """
+        Feed new samples (1-D tensor) and return the logits of every hop they complete.
+
+        Hops before the first context_tokens tokens exist, and hops that produced no new
+        token, emit no logits.
+        """
+        samples = samples.reshape(-1).to(self.pending.device)
+        logits = []
+        while samples.numel():
+            take = min(self.hop_size - self.hop_samples, samples.numel())
+            self.push_frames(self.next_windows(samples[:take]))
+            samples = samples[take:]
+            self.hop_samples += take
+            if self.hop_samples == self.hop_size:
+                self.hop_samples = 0
+                if self.num_tokens >= self.context_tokens and self.num_tokens > self.emitted_tokens:
+                    logits.append(self.classify())
+        return logits
+
+    def flush(self):
+        # End of stream: emit the tokens held back for right padding and classify the last context
+        if self.layers[0].buffer is None:
+            return None
+        with torch.no_grad():
+            x = None
+            for layer in self.layers:
+                outputs = [] if x is None else [layer.push(x)]
+                x = torch.cat(outputs + [layer.flush()], dim=2)
+        self.append_tokens(x)
+        return self.classify() if self.num_tokens >= self.context_tokens else None
+
+    def next_windows(self, samples):
+        # Windows completed by the new samples, concatenated as (1, 1, num_windows * window_size)
+        self.pending = torch.cat([self.pending, samples])
+        windows = []
+        while True:
+            needed = self.window_size if self.window_tail is None else self.step_size
+            if self.pending.numel() < needed:
+                break
+            new_samples, self.pending = self.pending[:needed], self.pending[needed:]
+            window = new_samples if self.window_tail is None else torch.cat([self.window_tail, new_samples])
+            self.window_tail = window[self.step_size:]
+            windows.append(window)
+        return torch.cat(windows).view(1, 1, -1) if windows else None
+
+    def push_frames(self, x):
+        if x is None:
+            return
+        device = next(self.model.parameters()).device
+        x = x.to(device)
+        with torch.no_grad():
+            for layer in self.layers:
+                x = layer.push(x)
+        self.append_tokens(x)
+
+    def append_tokens(self, x):
+        # Keep only the tokens the next classification can use
+        self.tokens = x if self.tokens is None else torch.cat([self.tokens, x], dim=2)[:, :, -self.context_tokens:]
+        self.num_tokens += x.size(2)
+
+    def classify(self):
+        self.emitted_tokens = self.num_tokens
+        tokens = self.tokens[:, :, -self.context_tokens:]
+        with torch.no_grad():
+            if isinstance(self.model, ConvolutionalTransformerClassifier):
+                return self.model.classify_tokens(tokens.transpose(1, 2))
+            return self.model.classify_features(tokens)
+
+def stream_windows(audio, window_size=16000, step_size=8000):
+    # Offline concatenated-window input for a contiguous stream, as CustomDataset builds it
+    return audio.unfold(0, window_size, step_size).reshape(1, 1, -1)
+
+def offline_stream_tokens(model, audio, window_size=16000, step_size=8000):
+    # (1, 512, num_tokens) conv tokens of the offline forward over the whole stream
+    x = stream_windows(audio, window_size, step_size).to(next(model.parameters()).device)
+    with torch.no_grad():
+        if isinstance(model, ConvolutionalTransformerClassifier):
+            return model.conv_base(x).transpose(1, 2)
+        return model.features(x)
+
+def check_streaming_equality(model, seconds=12.0, sampling_rate=16000, hop_seconds=1.0, chunk_seconds=0.3, tolerance=1e-5):
+    """
+    Largest absolute logit difference between StreamingClassifier and the offline forward.
+
+    This checks the incremental computation against one forward over the whole stream
+    (not against a per-hop 5 s forward, which differs by design; see benchmark_streaming_latency).
+
+    Random audio is streamed in chunks that do not line up with windows (cut at hops, so
+    the token count after a push is the one its logits saw). Every
+    emitted hop, and the flushed end of the stream, is compared with the model head on
+    the matching tokens of one offline forward over the whole stream. Raises an
+    AssertionError when the deviation reaches tolerance (float32 rounding stays
+    around 1e-8 for Conv1DClassifier and 1e-6 for the transformer).
+    """
+    model = model.eval()
+    audio = torch.randn(int(seconds * sampling_rate))
+    engine = StreamingClassifier(model, sampling_rate, hop_seconds)
+    emitted = []
+    chunk_size = int(chunk_seconds * sampling_rate)
+    position = 0
+    while position < audio.numel():
+        take = min(chunk_size, engine.hop_size - engine.hop_samples)
+        for logits in engine.push(audio[position:position + take]):
+            emitted.append((logits, engine.num_tokens))
+        position += take
+    final_logits = engine.flush()
+    emitted.append((final_logits, engine.num_tokens))
+
+    tokens = offline_stream_tokens(model, audio)
+    if tokens.size(2) != engine.num_tokens:
+        raise AssertionError("streamed {} tokens, offline forward has {}".format(engine.num_tokens, tokens.size(2)))
+    deviation = 0.0
+    with torch.no_grad():
+        for logits, num_tokens in emitted:
+            if logits is None:
+                continue
+            context = tokens[:, :, num_tokens - engine.context_tokens:num_tokens]
+            if isinstance(model, ConvolutionalTransformerClassifier):
+                expected = model.classify_tokens(context.transpose(1, 2))
+            else:
+                expected = model.classify_features(context)
+            deviation = max(deviation, (logits - expected).abs().max().item())
+    if not deviation < tolerance:
+        raise AssertionError("streaming logits deviate by {:.3g} from the offline forward, tolerance {:.3g}"
+                             .format(deviation, tolerance))
+    return deviation
+
+def benchmark_streaming_latency(model, seconds=30.0, sampling_rate=16000, hop_seconds=1.0, window_size=16000,
+                                step_size=8000, context_windows=9):
+    """
+    Per-hop latency of StreamingClassifier against re-running the model on the last 5 s every hop.
+
+    The two paths do not compute the same logits (see StreamingClassifier), so at every hop
+    where the engine emits, its logits are compared with the re-run's: the largest absolute
+    logit difference and the fraction of hops with the same predicted class are reported.
+
+    Returns:
+        A DataFrame with the median and 95th percentile milliseconds per hop of both paths,
+        the hops each path emitted on and, for the streaming path, its deviation from the re-run.
+    """
+    model = model.eval()
+    device = next(model.parameters()).device
+    audio = torch.randn(int(seconds * sampling_rate))
+    hop_size = int(hop_seconds * sampling_rate)
+    context_size = window_size + (context_windows - 1) * step_size
+
+    def timed(function):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        function()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return (time.perf_counter() - start) * 1000
+
+    engine = StreamingClassifier(model, sampling_rate, hop_seconds, window_size, step_size, context_windows)
+    streaming, naive = [], []
+    deviations, agreements = [], []
+    for end in range(hop_size, audio.numel() + 1, hop_size):
+        emitted = []
+        streaming_ms = timed(lambda: emitted.extend(engine.push(audio[end - hop_size:end])))
+        if end < context_size:
+            continue
+        streaming.append(streaming_ms)
+        buffer = stream_windows(audio[end - context_size:end], window_size, step_size).to(device)
+        rerun = []
+        with torch.no_grad():
+            naive.append(timed(lambda: rerun.append(model(buffer))))
+        if emitted:
+            deviations.append((emitted[-1] - rerun[0]).abs().max().item())
+            agreements.append(float(emitted[-1].argmax() == rerun[0].argmax()))
+
+    rows = [{"path": "streaming", "median_ms": float(np.median(streaming)),
+             "p95_ms": float(np.percentile(streaming, 95)), "emitting_hops": len(deviations),
+             "max_logit_deviation": max(deviations, default=float("nan")),
+             "argmax_agreement": float(np.mean(agreements)) if agreements else float("nan")},
+            {"path": "naive re-run", "median_ms": float(np.median(naive)),
+             "p95_ms": float(np.percentile(naive, 95)), "emitting_hops": len(naive),
+             "max_logit_deviation": 0.0, "argmax_agreement": 1.0}]
+    return pd.DataFrame(rows)
+
+class EventSegmenter:
+    """
+    Merges consecutive timeline frames whose class probability reaches the threshold into events.
+
+    Only the open segment of each class is kept, so the state does not grow with the recording.
+    """
+
+    def __init__(self, categories, hop_seconds, clip_seconds, threshold=0.5):
+        self.categories = categories
+        self.hop_seconds = hop_seconds
+        self.clip_seconds = clip_seconds
+        self.threshold = threshold
+        self.open_segments = {}  # class index -> [first frame, last frame, peak probability]
+        self.events = []
+
+    def update(self, frame_index, probabilities):
+        active = set(np.flatnonzero(probabilities >= self.threshold).tolist())
+        for class_index in list(self.open_segments):
+            if class_index not in active:
+                self.close(class_index)
+        for class_index in active:
+            segment = self.open_segments.setdefault(class_index, [frame_index, frame_index, 0.0])
+            segment[1] = frame_index
+            segment[2] = max(segment[2], float(probabilities[class_index]))
+
+    def close(self, class_index):
+        first_frame, last_frame, peak = self.open_segments.pop(class_index)
+        self.events.append({"label": str(self.categories[class_index]),
+                            "start": round(first_frame * self.hop_seconds, 3),
+                            "end": round(last_frame * self.hop_seconds + self.clip_seconds, 3),
+                            "peak_probability": round(peak, 4)})
+
+    def finish(self):
+        for class_index in list(self.open_segments):
+            self.close(class_index)
+        return sorted(self.events, key=lambda event: event["start"])
+
+def classify_long_recording(model, path, output_prefix, categories, new_sampling_rate=16000, hop_seconds=2.5,
+                            chunk_seconds=60.0, batch_size=32, threshold=0.5, window_size=16000, step_size=8000,
+                            clip_windows=9):
+    """
+    Tag an arbitrarily long recording with a probability timeline and merged event segments.
+
+    The file is decoded and resampled chunk by chunk with resample_span, which reads the
+    resampling kernel margin around every chunk, so chunk boundaries match a whole-file
+    resample. Clips of clip_windows windows (5 s) start every hop_seconds (the last one
+    zero-padded past the end of the recording, so the tail is covered), are split into
+    windows as in CustomDataset and go through the model in batches. Only one chunk, the
+    audio of the clips still pending and one batch are held, whatever the file length.
+
+    Writes:
+        <output_prefix>.timeline.npy: (num_clips, num_classes) float16 probabilities, written through a memmap
+        <output_prefix>.events.json: hop, clip length, categories, the merged event segments, the
+            recording's duration and the seconds of zero padding in the last clip (for a recording
+            shorter than a clip, most of its only clip is padding)
+
+    Returns:
+        The event segments, sorted by start time.
+    """
+    device = next(model.parameters()).device
+    model = model.eval()
+    info = torchaudio.info(path)
+    num_frames = info.num_frames
+    resampler = resampler_bank.get(info.sample_rate, new_sampling_rate)
+    period_in = resampler.orig_freq // resampler.gcd
+    period_out = resampler.new_freq // resampler.gcd
+    clip_size = window_size + (clip_windows - 1) * step_size
+    hop_size = int(hop_seconds * new_sampling_rate)
+    resampled_length = -(-num_frames * period_out // period_in)
+    # The last clip may run past the end of the recording; its tail is zero-padded
+    num_clips = max(-(-(resampled_length - clip_size) // hop_size) + 1, 1)
+    padded_length = (num_clips - 1) * hop_size + clip_size
+
+    timeline = np.lib.format.open_memmap(output_prefix + ".timeline.npy", mode="w+", dtype=np.float16,
+                                         shape=(num_clips, len(categories)))
+    segmenter = EventSegmenter(categories, hop_seconds, clip_size / new_sampling_rate, threshold)
+
+    def read_frames(frame_offset, count):
+        # Seeks into the file and decodes only the requested frames, downmixed to mono
+        audio = torchaudio.load(path, frame_offset=frame_offset, num_frames=count, normalize=True)[0]
+        return audio.mean(dim=0, keepdim=True)
+
+    # Chunks start on whole resampling periods, as resample_span requires
+    chunk_frames = max(round(chunk_seconds * info.sample_rate / period_in), 1) * period_in
+    buffer = torch.zeros(0)
+    buffer_start = 0  # resampled position of buffer[0]
+    next_clip = 0
+    for start in range(0, num_frames, chunk_frames):
+        stop = min(start + chunk_frames, num_frames)
+        buffer = torch.cat([buffer, resample_span(read_frames, num_frames, resampler, start, stop)[0]])
+        if stop == num_frames and buffer_start + buffer.numel() < padded_length:
+            # Final partial clip (and recordings shorter than a clip)
+            buffer = F.pad(buffer, (0, padded_length - buffer_start - buffer.numel()))
+
+        # Full batches only, except for the last clips of the recording
+        while next_clip < num_clips:
+            available = (buffer_start + buffer.numel() - clip_size) // hop_size + 1 - next_clip
+            count = min(batch_size, num_clips - next_clip, available)
+            if count <= 0 or count < min(batch_size, num_clips - next_clip):
+                break
+            offset = next_clip * hop_size - buffer_start
+            clips = buffer[offset:].unfold(0, clip_size, hop_size)[:count]
+            x = clips.unfold(1, window_size, step_size).reshape(count, 1, -1).to(device)
+            with torch.no_grad():
+                probabilities = F.softmax(model(x).float(), dim=1).cpu().numpy()
+            timeline[next_clip:next_clip + count] = probabilities
+            for row, frame_probabilities in enumerate(probabilities):
+                segmenter.update(next_clip + row, frame_probabilities)
+            next_clip += count
+
+        # Drop the audio no pending clip starts in
+        consumed = next_clip * hop_size - buffer_start
+        if consumed > 0:
+            buffer = buffer[consumed:]
+            buffer_start += consumed
+
+    timeline.flush()
+    del timeline
+    events = segmenter.finish()
+    with open(output_prefix + ".events.json", "w") as f:
+        json.dump({"path": str(path), "hop_seconds": hop_seconds, "clip_seconds": clip_size / new_sampling_rate,
+                   "duration_seconds": resampled_length / new_sampling_rate,
+                   "last_clip_padding_seconds": (padded_length - resampled_length) / new_sampling_rate,
+                   "categories": [str(category) for category in categories], "events": events}, f, indent=2)
+    return events
+
 num_classes = len(custom_data_module.training_dataset.categories)
 d_model = 512
 num_heads = 1  # Change to 2 or 4 for different number of attention heads
 num_layers = 2
+
+# Attention backends: numerical check of the fused and chunked paths against the reference
+print('Attention backend deviation: ', check_attention_backends())
+#print(benchmark_attention_backends())  # latency and peak memory across seq lengths and num_heads
+#print(benchmark_attention_scaling())  # linear-time backends against token count, e.g. attention_backend=['local', 'linear']
+
 model = ConvolutionalTransformerClassifier(num_classes, d_model, num_heads, num_layers)
+# frontend='contiguous' is cheaper but a different model: token deviation from the windowed frontend
+print('Contiguous frontend deviation (absolute, relative): ',
+      frontend_deviation(model.conv_base, x[0][:4], window_size=16000, step_size=8000))
+# Padded (bucket_batching) batches: a clip's logits must not depend on the longer clips it is batched with
+print('Padding deviation: ', check_padding_invariance(
+    ConvolutionalTransformerClassifier(num_classes, d_model, num_heads, num_layers, head='mean'),
+    custom_data_module.padded_collate_function))
+# Length-agnostic alternative: head='cls', 'mean', 'max' or 'attention' accepts clips of any length;
+# port_flatten_head_checkpoint(pooled_model, model.state_dict()) carries over a trained flatten-head model
 # Change the input dimension to match the final output shape of the transformer_layers
 #model.fc = nn.Linear(512 * 8, 10)  # Adjust accordingly if output shape changes
 
 # Train the Model
-trainer = pl.Trainer(max_epochs=100, default_root_dir='./logs')
+trainer = pl.Trainer(max_epochs=100, default_root_dir='./logs', callbacks=[PaddingFractionCallback(), ThroughputCallback()],
+                     logger=LocalMetricLogger('./logs/transformer_metrics.jsonl'))
 trainer.fit(model, custom_data_module)
 
 # Test the Model
 trainer.test(datamodule=custom_data_module)
-
-num_head = 2
-model_2head = ConvolutionalTransformerClassifier(num_classes, d_model, num_h, num_layers)
-
-num_epochs = 100
-train_model(model_2head, custom_data_module, criterion, optimizer, num_epochs)
-
-# Evaluate the model on the validation set
-evaluate_validation_set(model_2head, custom_data_module.val_dataloader())
-
-# Evaluate the model on the test set
-evaluate_test_set(model_2head, custom_data_module.test_dataloader())
-
-num_head = 4
-model_4head = ConvolutionalTransformerClassifier(num_classes, d_model, num_h, num_layers)
-
-num_epochs = 100
-train_model(model_4head, custom_data_module, criterion, optimizer, num_epochs)
-
-# Evaluate the model on the validation set
-evaluate_validation_set(model_4head, custom_data_module.val_dataloader())
-
-# Evaluate the model on the test set
-evaluate_test_set(model_4head, custom_data_module.test_dataloader())
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+#print(model.test_evaluation.confusion_matrix())  # derived from the stored test logits, no extra pass
+
+"""Transformer head sweep on cached conv features"""
+
+# Freeze the trained conv frontend once and cache its tokens for every clip
+# (conv_base_from_conv1d_classifier(...) reuses a trained Conv1DClassifier conv stack instead)
+feature_cache = ConvFeatureCache('/content/feature_cache', model.conv_base)
+token_data_module = CachedTokenDataModule(feature_cache, custom_data_module, batch_size=batch_size)
+
+# Only the transformer layers and fc are trained, on the cached (N, seq, 512) tokens
+for num_heads in (2, 4):
+    head_model = ConvolutionalTransformerClassifier(num_classes, d_model, num_heads, num_layers, frontend="cached")
+    head_trainer = pl.Trainer(max_epochs=100, default_root_dir='./logs')
+    head_trainer.fit(head_model, token_data_module)
+    head_trainer.test(head_model, datamodule=token_data_module)
+
+"""Streaming inference"""
+
+# Per-hop logits over a live stream; each hop only convolves the new samples
+print('Streaming deviation from the offline forward: ', check_streaming_equality(model))
+#print(benchmark_streaming_latency(model))  # per-hop latency and logit deviation against re-running the last 5 s
+#engine = StreamingClassifier(model, hop_seconds=1.0)
+#for chunk in microphone_chunks:  # 1-D float tensors at 16 kHz
+#    for logits in engine.push(chunk):
+#        print(custom_data_module.training_dataset.categories[logits.argmax().item()])
+
+"""Long recordings"""
+
+# Multi-hour files: chunked decode and resampling, float16 timeline plus merged events (memory independent of length)
+#events = classify_long_recording(model, '/content/field_recording.wav', '/content/field_recording',
+#                                 custom_data_module.training_dataset.categories, hop_seconds=2.5)
+#print(pd.DataFrame(events))
+
+"""Batch inference"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+audio_extensions = (".wav", ".flac", ".ogg", ".mp3")
+
+def list_inference_inputs(input_path, audio_root=None, file_column="filename"):
+    # Audio files of a directory (recursive), or the file column of a CSV manifest resolved against audio_root
+    input_path = Path(input_path)
+    if input_path.is_dir():
+        return sorted(str(path) for path in input_path.rglob("*") if path.suffix.lower() in audio_extensions)
+    audio_root = Path(audio_root) if audio_root is not None else input_path.parent
+    return [str(audio_root / name) for name in pd.read_csv(input_path, usecols=[file_column])[file_column]]
+
+def build_inference_model(model_name, checkpoint_path, num_heads=1, num_layers=2, head="flatten"):
+    # Conv1DClassifier ("conv1d") or ConvolutionalTransformerClassifier ("transformer") from a
+    # state_dict file or a Lightning checkpoint; the class count is read from the final layer
+    checkpoint = torch.load(checkpoint_path, map_location="cpu")
+    state_dict = checkpoint.get("state_dict", checkpoint)
+    if model_name == "conv1d":
+        model = Conv1DClassifier(state_dict["fc2.weight"].size(0), head=head)
+    elif model_name == "transformer":
+        model = ConvolutionalTransformerClassifier(state_dict["fc.weight"].size(0), 512, num_heads, num_layers, head=head)
+    else:
+        raise ValueError("unknown model {!r}, expected 'conv1d' or 'transformer'".format(model_name))
+    model.load_state_dict(state_dict)
+    return model.eval()
+
+def clip_to_windows(audio, clip_size=80000, window_size=16000, step_size=8000):
+    # 1-D audio cropped or zero-padded to one clip, in the models' concatenated-window layout
+    audio = F.pad(audio[:clip_size], (0, max(clip_size - audio.numel(), 0)))
+    return audio.unfold(0, window_size, step_size).reshape(-1)
+
+def decode_inference_clip(path, new_sampling_rate=16000, clip_size=80000, window_size=16000, step_size=8000):
+    # Runs in a decode process: mono, resampled, one clip in the windowed layout, plus the file's duration
+    # in seconds (files longer than a clip are cropped to their first clip_size samples)
+    audio, sampling_rate = torchaudio.load(path, normalize=True)
+    duration = audio.size(1) / sampling_rate
+    audio = resampler_bank(audio.mean(dim=0, keepdim=True), sampling_rate, new_sampling_rate)[0]
+    return clip_to_windows(audio, clip_size, window_size, step_size).numpy(), duration
+
+def decode_worker_init():
+    # One intra-op thread per decode process, the cores are shared by the pool
+    torch.set_num_threads(1)
+
+def completed_inference_paths(output_directory):
+    # Paths already written by earlier (possibly interrupted) runs
+    completed = set()
+    for part in sorted(Path(output_directory).glob("part-*.parquet")):
+        completed.update(pq.read_table(part, columns=["path"]).column("path").to_pylist())
+    return completed
+
+def run_batch_inference(model, input_paths, output_directory, categories=None, batch_size=64, decode_workers=4,
+                        forward_threads=2, rows_per_part=4096, embeddings=False, new_sampling_rate=16000,
+                        window_size=16000, step_size=8000, clip_windows=9):
+    """
+    Predict every file and write the results as Parquet parts, skipping files done by earlier runs.
+
+    Files are decoded and resampled on a process pool (at most a few batches ahead), and
+    full batches are forwarded on a thread pool. Each part holds rows_per_part rows with the
+    path, predicted class, its probability, all class probabilities and, with embeddings=True,
+    the input of the final linear layer. Every file is classified from its first clip (5 s,
+    zero-padded when shorter); the rows carry the file's duration, a `truncated` flag for
+    files that were longer, which classify_long_recording can tag over their full length, and
+    `padded_fraction`, the share of the clip that is zero padding (a 1 s file scores as 80% silence). A part is written to a temporary file and renamed, so
+    an interrupted run leaves only complete parts behind and a rerun continues after them.
+
+    Returns:
+        A dict with the number of predicted and failed files, the seconds taken and files per second.
+    """
+    output_directory = Path(output_directory)
+    output_directory.mkdir(parents=True, exist_ok=True)
+    completed = completed_inference_paths(output_directory)
+    todo = [path for path in input_paths if path not in completed]
+    # Continue after the highest existing part, so a gap (deleted part) never leads to an overwrite
+    part_index = max([int(part.stem.split("-", 1)[1]) for part in output_directory.glob("part-*.parquet")
+                      if part.stem.split("-", 1)[1].isdigit()], default=-1) + 1
+    clip_size = window_size + (clip_windows - 1) * step_size
+    device = next(model.parameters()).device
+    model = model.eval()
+    if device.type == "cpu":
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // forward_threads))
+    else:
+        forward_threads = 1
+
+    # The final layer's input, captured per forward thread
+    final_layer = model.fc2 if isinstance(model, Conv1DClassifier) else model.fc
+    captured = threading.local()
+    hook = final_layer.register_forward_hook(lambda module, inputs, output: setattr(captured, "embedding", inputs[0])) \
+        if embeddings else None
+
+    def forward(paths, clips, durations):
+        x = torch.from_numpy(np.stack(clips)).unsqueeze(1).to(device)
+        with torch.no_grad():
+            probabilities = F.softmax(model(x).float(), dim=1).cpu()
+        embedding = captured.embedding.float().cpu().numpy() if embeddings else None
+        return paths, probabilities.numpy(), embedding, durations
+
+    clip_seconds = clip_size / new_sampling_rate
+    rows = {"path": [], "duration_seconds": [], "truncated": [], "padded_fraction": [], "class_index": [], "label": [],
+            "probability": [], "probabilities": [], "embedding": []}
+
+    def write_part():
+        nonlocal part_index
+        if not rows["path"]:
+            return
+        columns = {name: values for name, values in rows.items()
+                   if (name != "embedding" or embeddings) and (name != "label" or categories is not None)}
+        table = pa.table({name: pa.array(values, type=pa.list_(pa.float32())) if name in ("probabilities", "embedding")
+                          else pa.array(values) for name, values in columns.items()})
+        path = output_directory / "part-{:05d}.parquet".format(part_index)
+        pq.write_table(table, str(path) + ".tmp")
+        os.replace(str(path) + ".tmp", path)
+        part_index += 1
+        for values in rows.values():
+            values.clear()
+
+    def collect(result):
+        paths, probabilities, embedding, durations = result
+        predicted = probabilities.argmax(axis=1)
+        rows["path"].extend(paths)
+        rows["duration_seconds"].extend(durations)
+        # Small tolerance for rounding of the resampled length
+        truncated = [duration > clip_seconds + 1e-3 for duration in durations]
+        rows["truncated"].extend(truncated)
+        truncated_files.extend(path for path, is_truncated in zip(paths, truncated) if is_truncated)
+        padded_fractions = [max(1.0 - duration / clip_seconds, 0.0) for duration in durations]
+        rows["padded_fraction"].extend(padded_fractions)
+        padded_files.extend(path for path, duration in zip(paths, durations) if duration < clip_seconds - 1e-3)
+        rows["class_index"].extend(predicted.tolist())
+        if categories is not None:
+            rows["label"].extend(str(categories[index]) for index in predicted)
+        rows["probability"].extend(probabilities[np.arange(len(paths)), predicted].tolist())
+        rows["probabilities"].extend(list(probabilities))
+        if embeddings:
+            rows["embedding"].extend(list(embedding))
+        if len(rows["path"]) >= rows_per_part:
+            write_part()
+
+    failed, truncated_files, padded_files = [], [], []
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(decode_workers, initializer=decode_worker_init) as decoders, \
+            ThreadPoolExecutor(forward_threads) as forwarders:
+        max_decoding = batch_size * 2 * max(decode_workers, 1)
+        decoding, forwarding = deque(), deque()
+        batch_paths, batch_clips, batch_durations = [], [], []
+        inputs = iter(todo)
+        progress = tqdm(total=len(todo), unit="file")
+        while True:
+            # Keep a bounded number of files decoding
+            for path in inputs:
+                decoding.append((path, decoders.submit(decode_inference_clip, path, new_sampling_rate, clip_size,
+                                                       window_size, step_size)))
+                if len(decoding) >= max_decoding:
+                    break
+            if not decoding:
+                break
+            path, future = decoding.popleft()
+            try:
+                clip, duration = future.result()
+                batch_clips.append(clip)
+                batch_durations.append(duration)
+                batch_paths.append(path)
+            except Exception as error:
+                failed.append((path, repr(error)))
+            if len(batch_paths) == batch_size or (not decoding and batch_paths):
+                forwarding.append(forwarders.submit(forward, batch_paths, batch_clips, batch_durations))
+                batch_paths, batch_clips, batch_durations = [], [], []
+            # Collect finished forwards in order, waiting only when too many are queued
+            while forwarding and (forwarding[0].done() or len(forwarding) > forward_threads * 2 or not decoding):
+                result = forwarding.popleft().result()
+                collect(result)
+                progress.update(len(result[0]))
+        progress.close()
+    write_part()
+    if hook is not None:
+        hook.remove()
+
+    seconds = time.perf_counter() - start_time
+    return {"files": len(todo) - len(failed), "failed": failed, "truncated": truncated_files, "padded": padded_files,
+            "skipped": len(completed), "seconds": seconds,
+            "files_per_second": (len(todo) - len(failed)) / max(seconds, 1e-9)}
+
+def parse_inference_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Batch inference over a directory or CSV manifest of audio files.")
+    parser.add_argument("--checkpoint", required=True, help="state_dict file or Lightning checkpoint")
+    parser.add_argument("--model", choices=("conv1d", "transformer"), default="conv1d")
+    parser.add_argument("--input", required=True, help="directory of audio files or CSV manifest")
+    parser.add_argument("--audio-root", default=None, help="directory the manifest's file names are relative to")
+    parser.add_argument("--file-column", default="filename")
+    parser.add_argument("--output", required=True, help="directory for the Parquet parts")
+    parser.add_argument("--categories", nargs="*", default=None, help="class names in class-index order")
+    parser.add_argument("--head", default="flatten")
+    parser.add_argument("--num-heads", type=int, default=1)
+    parser.add_argument("--num-layers", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--decode-workers", type=int, default=4)
+    parser.add_argument("--forward-threads", type=int, default=2)
+    parser.add_argument("--rows-per-part", type=int, default=4096)
+    parser.add_argument("--embeddings", action="store_true", help="also store the final layer's input")
+    parser.add_argument("--device", default="cpu")
+    return parser.parse_args(argv)
+
+def batch_inference_main(argv=None):
+    arguments = parse_inference_arguments(argv)
+    model = build_inference_model(arguments.model, arguments.checkpoint, arguments.num_heads, arguments.num_layers,
+                                  arguments.head).to(arguments.device)
+    input_paths = list_inference_inputs(arguments.input, arguments.audio_root, arguments.file_column)
+    report = run_batch_inference(model, input_paths, arguments.output, categories=arguments.categories,
+                                 batch_size=arguments.batch_size, decode_workers=arguments.decode_workers,
+                                 forward_threads=arguments.forward_threads, rows_per_part=arguments.rows_per_part,
+                                 embeddings=arguments.embeddings)
+    print("{files} files in {seconds:.1f} s ({files_per_second:.1f} files/s), {skipped} already done, "
+          "{0} failed, {1} longer than a clip (classified from their first clip only, see the truncated column), "
+          "{2} shorter than a clip (zero-padded, see the padded_fraction column)"
+          .format(len(report["failed"]), len(report["truncated"]), len(report["padded"]), **report))
+    return report
+
+#batch_inference_main(['--checkpoint', '/content/conv1d.pt', '--model', 'conv1d',
+#                      '--input', '/content/ESC-50-master/audio', '--output', '/content/predictions'])
+
+"""Inference server"""
+
+import asyncio
+
+class MicroBatcher:
+    """
+    Dynamic batching of single-clip requests for one model.
+
+    Requests wait in an asyncio queue. The batching loop takes the first waiting clip,
+    then keeps collecting until max_batch_size clips are gathered or max_wait_ms have
+    passed since the first one, runs the batched forward on a worker thread (the event
+    loop keeps accepting requests meanwhile) and resolves every request's future.
+    The batch sizes and the queue depths seen at batch formation are kept as histograms.
+    """
+
+    def __init__(self, model, max_batch_size=32, max_wait_ms=5.0):
+        self.model = model.eval()
+        self.device = next(model.parameters()).device
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.queue = None
+        self.executor = ThreadPoolExecutor(1)
+        self.batch_sizes = Counter()
+        self.queue_depths = Counter()  # power-of-two buckets: 0, 1, 2, 4, ...
+        self.requests = 0
+
+    async def submit(self, windows):
+        # windows: 1-D tensor in the concatenated-window layout; returns the class probabilities
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((windows, future))
+        return await future
+
+    def forward(self, clips):
+        x = torch.stack(clips).unsqueeze(1).to(self.device)
+        with torch.no_grad():
+            return F.softmax(self.model(x).float(), dim=1).cpu()
+
+    async def run(self):
+        self.queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait_ms / 1000
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            depth = self.queue.qsize()
+            self.queue_depths[0 if depth == 0 else 1 << (depth.bit_length() - 1)] += 1
+            self.batch_sizes[len(batch)] += 1
+            self.requests += len(batch)
+
+            clips, futures = zip(*batch)
+            try:
+                probabilities = await loop.run_in_executor(self.executor, self.forward, list(clips))
+            except Exception as error:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            for future, row in zip(futures, probabilities):
+                if not future.done():  # the client may have gone away
+                    future.set_result(row)
+
+    def metrics(self):
+        return {"requests": self.requests,
+                "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+                "batch_size_histogram": dict(sorted(self.batch_sizes.items())),
+                "queue_depth_histogram": dict(sorted(self.queue_depths.items())),
+                "mean_batch_size": self.requests / max(sum(self.batch_sizes.values()), 1)}
+
+class PredictionCache:
+    """
+    Class probabilities keyed by a hash of the decoded, resampled clip and the model's weights.
+
+    A bounded in-memory LRU sits in front of an optional on-disk tier (one .npy per entry,
+    written to a temporary file and renamed, so processes can share the directory). The
+    model fingerprint is part of every key, so retrained weights never see stale entries.
+    Safe to use from several threads; hits, disk hits, misses and evictions are counted.
+    """
+
+    def __init__(self, model, max_entries=10000, cache_directory=None):
+        self.model_version = module_fingerprint(model)[:16]
+        self.max_entries = max_entries
+        self.cache_directory = None
+        if cache_directory is not None:
+            self.cache_directory = Path(cache_directory) / self.model_version
+            self.cache_directory.mkdir(parents=True, exist_ok=True)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = Counter(hits=0, disk_hits=0, misses=0, evictions=0)
+
+    def key(self, windows):
+        # BLAKE2b of the PCM bytes (after resampling and windowing) plus the model version
+        digest = hashlib.blake2b(windows.detach().cpu().contiguous().numpy().tobytes(), digest_size=16)
+        digest.update(self.model_version.encode())
+        return digest.hexdigest()
+
+    def _disk_path(self, key):
+        return self.cache_directory / key[:2] / (key + ".npy")
+
+    def get(self, key):
+        probabilities = self.get_memory(key)
+        return probabilities if probabilities is not None else self.get_disk(key)
+
+    def get_memory(self, key):
+        # In-memory tier only; a None here is not yet counted as a miss
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return self._entries[key]
+        return None
+
+    def get_disk(self, key):
+        # On-disk tier (blocking file I/O); counts a disk hit or a miss
+        if self.cache_directory is not None and self._disk_path(key).exists():
+            probabilities = torch.from_numpy(np.load(self._disk_path(key)))
+            with self._lock:
+                self.counters["disk_hits"] += 1
+            self._remember(key, probabilities)
+            return probabilities
+        with self._lock:
+            self.counters["misses"] += 1
+        return None
+
+    def put(self, key, probabilities):
+        probabilities = self.put_memory(key, probabilities)
+        self.put_disk(key, probabilities)
+
+    def put_memory(self, key, probabilities):
+        probabilities = probabilities.detach().cpu()
+        self._remember(key, probabilities)
+        return probabilities
+
+    def put_disk(self, key, probabilities):
+        # Blocking file I/O; a no-op without a cache_directory
+        if self.cache_directory is not None:
+            probabilities = probabilities.detach().cpu()
+            path = self._disk_path(key)
+            path.parent.mkdir(exist_ok=True)
+            temporary_path = path.parent / "{}.{}.{}.tmp".format(path.name, os.getpid(), threading.get_ident())
+            with open(temporary_path, "wb") as f:
+                np.save(f, probabilities.numpy())
+            os.replace(temporary_path, path)
+
+    def _remember(self, key, probabilities):
+        with self._lock:
+            self._entries[key] = probabilities
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def predict(self, windows, compute):
+        # Cached probabilities of a clip, or compute(windows) on a miss
+        key = self.key(windows)
+        probabilities = self.get(key)
+        if probabilities is None:
+            probabilities = compute(windows)
+            self.put(key, probabilities)
+        return probabilities
+
+    def metrics(self):
+        with self._lock:
+            lookups = self.counters["hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            return dict(self.counters, entries=len(self._entries),
+                        hit_rate=(self.counters["hits"] + self.counters["disk_hits"]) / max(lookups, 1))
+
+class InferenceServer:
+    """
+    Minimal HTTP/1.1 front end on asyncio streams, one request per connection.
+
+    POST /predict: raw little-endian float32 samples at new_sampling_rate (Content-Type
+        application/octet-stream) or an audio file (audio/wav, audio/flac, ...); answers the
+        predicted class, its probability and all class probabilities as JSON
+    GET /metrics: MicroBatcher.metrics() (and the PredictionCache counters) as JSON
+
+    With a prediction_cache, repeated clips are answered without entering the batch queue.
+    Bodies are decoded (torchaudio.load, resampling) on decode_threads worker threads so the
+    event loop keeps accepting requests and feeding the batcher meanwhile.
+    """
+
+    def __init__(self, model, categories=None, host="127.0.0.1", port=8080, max_batch_size=32, max_wait_ms=5.0,
+                 new_sampling_rate=16000, window_size=16000, step_size=8000, clip_windows=9, prediction_cache=None,
+                 decode_threads=2):
+        self.batcher = MicroBatcher(model, max_batch_size, max_wait_ms)
+        self.decode_executor = ThreadPoolExecutor(decode_threads)
+        self.prediction_cache = prediction_cache
+        self.categories = categories
+        self.host = host
+        self.port = port
+        self.new_sampling_rate = new_sampling_rate
+        self.window_size = window_size
+        self.step_size = step_size
+        self.clip_size = window_size + (clip_windows - 1) * step_size
+        self.server = None
+        self.batcher_task = None
+
+    async def start(self, sock=None):
+        # sock: an already listening socket, shared by the pre-forked workers of PreforkServer
+        self.batcher_task = asyncio.ensure_future(self.batcher.run())
+        if sock is not None:
+            self.server = await asyncio.start_server(self.handle, sock=sock)
+        else:
+            self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        # port=0 picks a free port
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.batcher_task.cancel()
+        self.decode_executor.shutdown(wait=False)
+
+    def decode(self, body, content_type):
+        # Malformed bodies raise ValueError (answered with 400); anything else is a server fault (500)
+        if not body:
+            raise ValueError("empty request body")
+        if content_type.startswith("audio/"):
+            try:
+                audio, sampling_rate = torchaudio.load(io.BytesIO(body), normalize=True)
+            except RuntimeError as error:
+                raise ValueError("cannot decode {} body: {}".format(content_type, error))
+            audio = resampler_bank(audio.mean(dim=0, keepdim=True), sampling_rate, self.new_sampling_rate)[0]
+        else:
+            if len(body) % 4:
+                raise ValueError("raw body of {} bytes is not a whole number of float32 samples".format(len(body)))
+            audio = torch.from_numpy(np.frombuffer(body, dtype="<f4").copy())
+            if not torch.isfinite(audio).all():
+                raise ValueError("raw samples contain NaN or infinity")
+        return clip_to_windows(audio, self.clip_size, self.window_size, self.step_size)
+
+    async def handle(self, reader, writer):
+        try:
+            method, target, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, value = line.decode("latin-1").split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            if method == "GET" and target == "/metrics":
+                status, payload = 200, self.batcher.metrics()
+                if self.prediction_cache is not None:
+                    payload["prediction_cache"] = self.prediction_cache.metrics()
+            elif method == "POST" and target == "/predict":
+                loop = asyncio.get_event_loop()
+                windows = await loop.run_in_executor(
+                    self.decode_executor, self.decode, body, headers.get("content-type", ""))
+                key = self.prediction_cache.key(windows) if self.prediction_cache is not None else None
+                probabilities = None
+                if key is not None:
+                    # The disk tier does blocking np.load / np.save / os.replace, so it runs off the loop
+                    probabilities = self.prediction_cache.get_memory(key)
+                    if probabilities is None:
+                        probabilities = await loop.run_in_executor(
+                            self.decode_executor, self.prediction_cache.get_disk, key)
+                if probabilities is None:
+                    probabilities = await self.batcher.submit(windows)
+                    if key is not None:
+                        probabilities = self.prediction_cache.put_memory(key, probabilities)
+                        await loop.run_in_executor(
+                            self.decode_executor, self.prediction_cache.put_disk, key, probabilities)
+                class_index = int(probabilities.argmax())
+                payload = {"class_index": class_index, "probability": float(probabilities[class_index]),
+                           "probabilities": probabilities.tolist()}
+                if self.categories is not None:
+                    payload["label"] = str(self.categories[class_index])
+                status = 200
+            else:
+                status, payload = 404, {"error": "unknown route {} {}".format(method, target)}
+        except (ValueError, asyncio.IncompleteReadError) as error:
+            # Malformed request line, headers or body; inference errors (e.g. CUDA OOM) fall through to 500
+            status, payload = 400, {"error": repr(error)}
+        except Exception as error:
+            status, payload = 500, {"error": repr(error)}
+
+        response = json.dumps(payload).encode()
+        reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+        writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n"
+                     "Connection: close\r\n\r\n".format(status, reasons[status], len(response)).encode() + response)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+async def http_request(host, port, method, target, body=b"", content_type="application/octet-stream"):
+    # One request on a fresh connection; returns (status, decoded JSON body)
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write("{} {} HTTP/1.1\r\nHost: {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n"
+                 "Connection: close\r\n\r\n".format(method, target, host, content_type, len(body)).encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b"\r\n\r\n")
+    return int(head.split(b" ", 2)[1]), json.loads(payload)
+
+async def generate_load(host="127.0.0.1", port=8080, num_requests=1000, concurrency=64, clip_seconds=5.0,
+                        sampling_rate=16000):
+    """
+    Send num_requests random clips from `concurrency` concurrent clients.
+
+    Returns:
+        A dict with p50/p99 latency in milliseconds, throughput in requests per second and the error count.
+    """
+    body = np.random.randn(int(clip_seconds * sampling_rate)).astype("<f4").tobytes()
+    latencies, errors = [], 0
+    remaining = iter(range(num_requests))
+
+    async def client():
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                status, _ = await http_request(host, port, "POST", "/predict", body)
+            except (OSError, ValueError):
+                status = None
+            if status == 200:
+                latencies.append((time.perf_counter() - start) * 1000)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    return {"requests": num_requests, "errors": errors, "seconds": seconds,
+            "throughput_rps": len(latencies) / seconds,
+            "p50_ms": float(np.percentile(latencies, 50)) if latencies else float("nan"),
+            "p99_ms": float(np.percentile(latencies, 99)) if latencies else float("nan")}
+
+async def run_local_load_test(model, num_requests=1000, concurrency=64, max_batch_size=32, max_wait_ms=5.0):
+    # Server and load generator in one event loop on a free local port; returns (load report, server metrics)
+    server = InferenceServer(model, port=0, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    await server.start()
+    try:
+        report = await generate_load(server.host, server.port, num_requests, concurrency)
+        _, metrics = await http_request(server.host, server.port, "GET", "/metrics")
+    finally:
+        await server.stop()
+    return report, metrics
+
+def load_generator_main(argv=None):
+    # Load generator against a running server, e.g. on another machine
+    parser = argparse.ArgumentParser(description="Load generator for the inference server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    arguments = parser.parse_args(argv)
+    report = asyncio.run(generate_load(arguments.host, arguments.port, arguments.requests, arguments.concurrency))
+    print("{throughput_rps:.1f} req/s, p50 {p50_ms:.1f} ms, p99 {p99_ms:.1f} ms, {errors} errors".format(**report))
+    return report
+
+# In the notebook (an event loop is already running) await the coroutines directly
+# (InferenceServer(model, prediction_cache=PredictionCache(model, cache_directory='/content/prediction_cache'))
+# answers resubmitted clips from the cache):
+#report, metrics = await run_local_load_test(model, max_batch_size=32, max_wait_ms=5.0)
+#print(report, metrics)
+#report, metrics = await run_local_load_test(model, max_batch_size=1, max_wait_ms=0.0)  # one request per forward
+
+"""Multi-process serving"""
+
+import socket
+
+def proportional_set_size(pid):
+    # Proportional set size of a process in bytes: shared pages are split between the processes mapping them
+    with open("/proc/{}/smaps_rollup".format(pid)) as f:
+        for line in f:
+            if line.startswith("Pss:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def serve_prefork_worker(model, sock, threads, categories, server_kwargs, ready):
+    # Worker process: its own intra-op thread budget and event loop, accepting on the shared socket
+    torch.set_num_threads(threads)
+
+    async def serve():
+        server = InferenceServer(model, categories, **server_kwargs)
+        await server.start(sock=sock)
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+class PreforkServer:
+    """
+    N forked InferenceServer processes serving one model from shared memory.
+
+    The parent copies the model to the CPU and moves the copy's parameters and buffers to
+    shared memory once (share_memory(); the caller's model stays where it was), binds a single listening socket and forks the workers; they map
+    the same weight pages and the kernel spreads incoming connections over them. Each
+    worker gets cpu_count // num_workers intra-op threads, so the workers together do
+    not oversubscribe the cores. Pre- and post-processing then run in parallel, outside
+    any single interpreter lock.
+    """
+
+    def __init__(self, model, num_workers=4, threads_per_worker=None, categories=None, host="127.0.0.1", port=8080,
+                 **server_kwargs):
+        self.model = copy.deepcopy(model).cpu().eval().share_memory()
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // num_workers)
+        self.categories = categories
+        self.host = host
+        self.port = port
+        self.server_kwargs = server_kwargs
+        self.sock = None
+        self.workers = []
+
+    def start(self, timeout=60):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(1024)
+        self.port = self.sock.getsockname()[1]  # port=0 picks a free port
+
+        context = multiprocessing.get_context("fork")
+        readiness = []
+        for _ in range(self.num_workers):
+            ready = context.Event()
+            worker = context.Process(target=serve_prefork_worker, daemon=True,
+                                     args=(self.model, self.sock, self.threads_per_worker, self.categories,
+                                           self.server_kwargs, ready))
+            worker.start()
+            self.workers.append(worker)
+            readiness.append(ready)
+        for ready in readiness:
+            if not ready.wait(timeout):
+                self.stop()
+                raise RuntimeError("a serving worker did not start within {} s".format(timeout))
+        return self
+
+    def stop(self):
+        for worker in self.workers:
+            worker.terminate()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def worker_memory_mb(self):
+        # Proportional set size per worker: shared weights count once across all of them
+        return [proportional_set_size(worker.pid) / 1024 ** 2 for worker in self.workers]
+
+async def benchmark_prefork_throughput(model, worker_counts=(1, 2, 4, 8), num_requests=2000, concurrency=128,
+                                       max_batch_size=32, max_wait_ms=5.0):
+    """
+    Aggregate throughput and latency of PreforkServer against the number of worker processes.
+
+    The load generator runs in this process on one core; leave it a core when sizing workers.
+
+    Returns:
+        A DataFrame with one row per worker count, including the mean per-worker PSS.
+    """
+    rows = []
+    for num_workers in worker_counts:
+        server = PreforkServer(model, num_workers, port=0, max_batch_size=max_batch_size,
+                               max_wait_ms=max_wait_ms).start()
+        try:
+            report = await generate_load(server.host, server.port, num_requests, concurrency)
+            worker_memory = server.worker_memory_mb()
+        finally:
+            server.stop()
+        rows.append({"workers": num_workers, "threads_per_worker": server.threads_per_worker,
+                     "throughput_rps": report["throughput_rps"], "p50_ms": report["p50_ms"],
+                     "p99_ms": report["p99_ms"], "errors": report["errors"],
+                     "worker_pss_mb": float(np.mean(worker_memory))})
+    return pd.DataFrame(rows)
+
+# Pre-fork serving on one socket (serves until stop()):
+#prefork_server = PreforkServer(model, num_workers=8, categories=custom_data_module.training_dataset.categories).start()
+#print(await benchmark_prefork_throughput(model, worker_counts=(1, 2, 4, 8)))